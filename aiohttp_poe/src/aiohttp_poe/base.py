@@ -40,6 +40,20 @@ class _SSEResponse(EventSourceResponse):
                 raise asyncio.CancelledError()
 
 
+# How often to check whether the client of a streaming response is still there
+DISCONNECT_POLL_INTERVAL = 0.5
+
+
+def _is_disconnected(request: web.Request) -> bool:
+    transport = request.transport
+    return transport is None or transport.is_closing()
+
+
+async def _wait_for_disconnect(request: web.Request) -> None:
+    while not _is_disconnected(request):
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+
+
 async def authenticate(request: web.Request, token: str) -> bool:
     if auth_key is not None and token != auth_key:
         return False
@@ -59,6 +73,9 @@ async def auth_middleware(request: web.Request, handler):
 
 
 class PoeBot:
+    # Number of responses stopped early because the client went away
+    aborted_stream_count = 0
+
     async def __call__(self, request: web.Request) -> web.Response:
         body = await request.json()
         request_type = body["type"]
@@ -85,9 +102,34 @@ class PoeBot:
 
     async def __handle_query(self, query: QueryRequest, request: web.Request) -> None:
         async with sse_response(request, response_cls=_SSEResponse) as resp:
-            async for event_type, data in self.get_response(query, request):
-                await resp.send(json.dumps(data), event=event_type)
-            await resp.send("{}", event="done")
+            # Depending on the version and configuration, aiohttp may not cancel the
+            # handler when the client disconnects, so watch for that ourselves and
+            # stop generating a response that nobody will receive.
+            sender = asyncio.ensure_future(self.__send_response(query, request, resp))
+            watcher = asyncio.ensure_future(_wait_for_disconnect(request))
+            try:
+                await asyncio.wait(
+                    {sender, watcher}, return_when=asyncio.FIRST_COMPLETED
+                )
+            finally:
+                watcher.cancel()
+                if not sender.done():
+                    self.aborted_stream_count += 1
+                    sender.cancel()
+                    await asyncio.gather(sender, return_exceptions=True)
+            if sender.done() and not sender.cancelled():
+                error = sender.exception()
+                if isinstance(error, ConnectionResetError):
+                    self.aborted_stream_count += 1
+                elif error is not None:
+                    raise error
+
+    async def __send_response(
+        self, query: QueryRequest, request: web.Request, resp: EventSourceResponse
+    ) -> None:
+        async for event_type, data in self.get_response(query, request):
+            await resp.send(json.dumps(data), event=event_type)
+        await resp.send("{}", event="done")
 
     @staticmethod
     def text_event(text: str) -> Event:
@@ -0,0 +1,128 @@
+"""
+
+Benchmarks of the client's handling of bot responses.
+
+Serves canned responses through httpx.MockTransport, so only the client's own
+work is measured. Run with:
+
+    python benchmarks/bench_client.py
+
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from typing import Tuple
+
+import httpx
+
+from fastapi_poe.client import _BotContext, _decode_text
+from fastapi_poe.types import ProtocolMessage, QueryRequest
+
+CONTEXT_SIZES = (1, 100, 1000)
+# The client rejects responses of more than MAX_EVENT_COUNT events
+RESPONSE_LENGTHS = (100, 900)
+REPEATS = 5
+DECODE_COUNT = 100_000
+
+
+def make_request(context_size: int) -> QueryRequest:
+    messages = [
+        ProtocolMessage(role="user", content="hello world " * 50)
+        for _ in range(context_size)
+    ]
+    return QueryRequest(
+        version="1.0",
+        type="query",
+        query=messages,
+        user_id="u",
+        conversation_id="c",
+        message_id="m",
+    )
+
+
+def make_transport(response_length: int) -> httpx.MockTransport:
+    body = "".join(
+        f"event: text\ndata: {json.dumps({'text': f'token {i} '})}\n\n"
+        for i in range(response_length)
+    )
+    body += "event: done\ndata: {}\n\n"
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(
+            200, text=body, headers={"content-type": "text/event-stream"}
+        )
+
+    return httpx.MockTransport(handler)
+
+
+async def time_stream(
+    request: QueryRequest, response_length: int
+) -> Tuple[float, float]:
+    """Return the best times, in seconds, to the first event and per later event.
+
+    The time to the first event includes sending the request, which grows with
+    the context; the time per later event should not.
+
+    """
+    best_first = best_per_event = float("inf")
+    async with httpx.AsyncClient(transport=make_transport(response_length)) as session:
+        context = _BotContext(endpoint="http://bot/", api_key="key", session=session)
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            first = None
+            count = 0
+            async for _message in context.perform_query_request(request):
+                if first is None:
+                    first = time.perf_counter()
+                count += 1
+            end = time.perf_counter()
+            assert first is not None
+            best_first = min(best_first, first - start)
+            best_per_event = min(best_per_event, (end - first) / (count - 1))
+    return best_first, best_per_event
+
+
+async def bench_stream() -> None:
+    print("perform_query_request")
+    for context_size in CONTEXT_SIZES:
+        request = make_request(context_size)
+        for response_length in RESPONSE_LENGTHS:
+            first, per_event = await time_stream(request, response_length)
+            print(
+                f"  {context_size:5d} messages, {response_length:4d} events:"
+                f" first event {first * 1e3:6.2f} ms,"
+                f" then {per_event * 1e6:5.1f} us per event"
+            )
+
+
+async def bench_decode() -> None:
+    """Compare decoding the data of text events with and without a JSON parser."""
+    print("Decoding text events")
+    async with httpx.AsyncClient() as session:
+        context = _BotContext(endpoint="http://bot/", api_key="key", session=session)
+        for name, text in (("plain", "token 123 "), ("escaped", 'say "hi"\n')):
+            data = json.dumps({"text": text})
+            start = time.perf_counter()
+            for _ in range(DECODE_COUNT):
+                await context._get_single_json_field(data, "text", "m")
+            parsed = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(DECODE_COUNT):
+                if _decode_text(data) is None:
+                    await context._get_single_json_field(data, "text", "m")
+            decoded = time.perf_counter() - start
+            print(
+                f"  {name:7s} text: JSON parser {DECODE_COUNT / parsed:9.0f} events/s,"
+                f" client {DECODE_COUNT / decoded:9.0f} events/s"
+            )
+
+
+async def main() -> None:
+    await bench_stream()
+    await bench_decode()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,124 @@
+"""
+
+Benchmarks of the server's handling of queries.
+
+Requests are sent to the app in-process through httpx.ASGITransport, so only the
+framework's own work is measured. Run with:
+
+    python benchmarks/bench_server.py
+
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from typing import AsyncIterable, Iterator, Tuple
+
+import httpx
+from sse_starlette.sse import ServerSentEvent
+
+from fastapi_poe.base import PoeBot, make_app
+from fastapi_poe.types import QueryRequest
+
+API_KEY = "k" * 32
+HEADERS = {"Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json"}
+CONTEXT_SIZES = (1, 100, 1000)
+# Bots may send at most MAX_EVENT_COUNT events per response
+RESPONSE_LENGTH = 900
+REPEATS = 20
+
+
+class ShortBot(PoeBot):
+    async def get_response(self, query: QueryRequest) -> AsyncIterable[ServerSentEvent]:
+        yield self.text_event("hello")
+
+
+class LongBot(PoeBot):
+    async def get_response(self, query: QueryRequest) -> AsyncIterable[ServerSentEvent]:
+        for i in range(RESPONSE_LENGTH):
+            yield self.text_event(f"token {i} ")
+
+
+class CoalescingBot(LongBot):
+    text_coalesce_window = 0.01
+
+
+class SyncBot(PoeBot):
+    def get_response(  # type: ignore[override]
+        self, query: QueryRequest
+    ) -> Iterator[ServerSentEvent]:
+        for i in range(RESPONSE_LENGTH):
+            yield self.text_event(f"token {i} ")
+
+
+def make_body(context_size: int) -> str:
+    messages = [
+        {"role": "user", "content": "hello world " * 50, "message_id": str(i)}
+        for i in range(context_size)
+    ]
+    return json.dumps(
+        {
+            "version": "1.0",
+            "type": "query",
+            "query": messages,
+            "user_id": "u",
+            "conversation_id": "c",
+            "message_id": "m",
+        }
+    )
+
+
+async def time_query(
+    bot: PoeBot, body: str, *, fast_path: bool = False
+) -> Tuple[float, int]:
+    """Return the best time, in seconds, to answer a query and the frames sent."""
+    app = make_app(bot, API_KEY, fast_path=fast_path)
+    best = float("inf")
+    frames = 0
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://bot"
+    ) as client:
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            response = await client.post("/", content=body, headers=HEADERS)
+            best = min(best, time.perf_counter() - start)
+            assert response.status_code == 200, response.text
+            frames = response.text.count("event: ")
+    return best, frames
+
+
+async def bench_routes() -> None:
+    print("Default route and fast path, per query")
+    for context_size in CONTEXT_SIZES:
+        body = make_body(context_size)
+        default, _ = await time_query(ShortBot(), body)
+        fast, _ = await time_query(ShortBot(), body, fast_path=True)
+        print(
+            f"  {context_size:5d} messages: default {default * 1e3:6.2f} ms,"
+            f" fast path {fast * 1e3:6.2f} ms"
+        )
+
+
+async def bench_events() -> None:
+    print(f"Responses of {RESPONSE_LENGTH} text events")
+    body = make_body(1)
+    for name, bot in (
+        ("async generator", LongBot()),
+        ("with coalescing", CoalescingBot()),
+        ("sync generator", SyncBot()),
+    ):
+        elapsed, frames = await time_query(bot, body)
+        print(
+            f"  {name:16s} {RESPONSE_LENGTH / elapsed:9.0f} events/s,"
+            f" {frames:4d} frames"
+        )
+
+
+async def main() -> None:
+    await bench_routes()
+    await bench_events()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
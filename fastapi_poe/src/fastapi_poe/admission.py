@@ -0,0 +1,249 @@
+"""
+
+Admission control for bot servers: a concurrency limit with a bounded, per-user fair
+wait queue, per-user rate limits, and load shedding.
+
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import AsyncGenerator, AsyncIterable, Deque, Dict, Optional, TypeVar
+
+from typing_extensions import Literal, TypeAlias
+
+from .types import QueryRequest
+
+# The protocol requires the first response event within 5 seconds
+FIRST_RESPONSE_DEADLINE = 5.0
+# Leaves an admitted query time to produce its first event within that deadline
+DEFAULT_MAX_QUEUE_WAIT = 3.0
+
+FairnessKey: TypeAlias = Literal["user_id", "conversation_id"]
+T = TypeVar("T")
+
+
+class QueryRejected(Exception):
+    """Raised when a query is not admitted. Maps to an HTTP error response."""
+
+    def __init__(
+        self, message: str, status_code: int, retry_after: Optional[float] = None
+    ) -> None:
+        # All arguments are passed on, so that copies and pickles keep them
+        super().__init__(message, status_code, retry_after)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    def __str__(self) -> str:
+        return self.message
+
+
+@dataclass
+class _TokenBucket:
+    tokens: float
+    updated_at: float
+
+    def take(self, rate: float, burst: float, now: float) -> float:
+        """Take a token. Returns 0 on success, else the seconds until one is available."""
+        self.tokens = min(burst, self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+
+class AdmissionTicket:
+    """A slot held by an admitted query. Release it when the response is finished."""
+
+    def __init__(self, control: "AdmissionControl") -> None:
+        self._control = control
+        self._started_at = time.monotonic()
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._control._release(time.monotonic() - self._started_at)
+
+    async def wrap(self, events: AsyncIterable[T]) -> AsyncGenerator[T, None]:
+        """Pass *events* through and release the slot once they are exhausted."""
+        try:
+            async for event in events:
+                yield event
+        finally:
+            self.release()
+
+
+class AdmissionControl:
+    """Limits how many queries a bot works on at once.
+
+    Up to *max_concurrency* queries run concurrently. Further queries wait in a
+    queue of at most *max_queue_size* entries, which is served round-robin across
+    users (or conversations, depending on *fairness_key*) so that a single busy
+    user cannot starve everyone else.
+
+    A query is rejected with 503 right away if the queue is full or if its
+    estimated wait, based on recent response durations, exceeds *max_queue_wait*,
+    and also once it has waited that long without being admitted. Keep
+    *max_queue_wait* below the protocol's 5-second limit for the first event by
+    at least the time the bot needs to produce it once admitted. If
+    *rate_per_key* is set, each user additionally gets a token bucket of
+    *burst_per_key* queries refilled at *rate_per_key* queries per second, and
+    queries beyond it are rejected with 429.
+
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        *,
+        max_queue_size: int = 100,
+        max_queue_wait: float = DEFAULT_MAX_QUEUE_WAIT,
+        fairness_key: FairnessKey = "user_id",
+        rate_per_key: Optional[float] = None,
+        burst_per_key: float = 10.0,
+        max_tracked_keys: int = 10_000,
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.max_queue_wait = max_queue_wait
+        self.fairness_key = fairness_key
+        self.rate_per_key = rate_per_key
+        self.burst_per_key = burst_per_key
+        self.max_tracked_keys = max_tracked_keys
+
+        self.in_flight = 0
+        self.queue_depth = 0
+        self._waiters: "OrderedDict[str, Deque[asyncio.Future[None]]]" = OrderedDict()
+        self._buckets: "OrderedDict[str, _TokenBucket]" = OrderedDict()
+        # Exponentially weighted moving average of how long a query holds a slot
+        self._average_service_time: Optional[float] = None
+
+        self.admitted_count = 0
+        self.overload_rejected_count = 0
+        self.rate_limited_count = 0
+        self.queued_count = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def estimate_wait(self) -> float:
+        """Estimated seconds until a newly queued query would be admitted."""
+        if self._average_service_time is None:
+            return 0.0
+        position = self.queue_depth + 1
+        return self._average_service_time * position / self.max_concurrency
+
+    def get_stats(self) -> Dict[str, float]:
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "estimated_wait_seconds": self.estimate_wait(),
+            "admitted": self.admitted_count,
+            "queued": self.queued_count,
+            "rejected_overload": self.overload_rejected_count,
+            "rejected_rate_limited": self.rate_limited_count,
+            "average_wait_seconds": (
+                self.total_wait_time / self.queued_count if self.queued_count else 0.0
+            ),
+            "max_wait_seconds": self.max_wait_time,
+        }
+
+    async def acquire(self, query: QueryRequest) -> AdmissionTicket:
+        """Wait for a slot for *query*. Raises QueryRejected if it is not admitted."""
+        key = getattr(query, self.fairness_key)
+        if self.rate_per_key is not None:
+            self._take_token(key, self.rate_per_key)
+
+        if self.in_flight < self.max_concurrency and not self.queue_depth:
+            return self._admit()
+        if self.queue_depth >= self.max_queue_size:
+            self._reject_overload("Wait queue is full")
+        estimate = self.estimate_wait()
+        if estimate > self.max_queue_wait:
+            self._reject_overload(f"Estimated wait of {estimate:.1f}s is too long")
+
+        waiter: "asyncio.Future[None]" = asyncio.get_event_loop().create_future()
+        if key not in self._waiters:
+            self._waiters[key] = deque()
+        self._waiters[key].append(waiter)
+        self.queue_depth += 1
+        self.queued_count += 1
+        started_at = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_queue_wait)
+        except asyncio.TimeoutError:
+            if self._abandon(key, waiter):
+                self._reject_overload("Timed out waiting for a slot")
+        except BaseException:
+            if not self._abandon(key, waiter):
+                # We were handed a slot just as we gave up; pass it on.
+                self._release(None)
+            raise
+        finally:
+            wait_time = time.monotonic() - started_at
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+        self.admitted_count += 1
+        return AdmissionTicket(self)
+
+    def _admit(self) -> AdmissionTicket:
+        self.in_flight += 1
+        self.admitted_count += 1
+        return AdmissionTicket(self)
+
+    def _reject_overload(self, message: str) -> None:
+        self.overload_rejected_count += 1
+        raise QueryRejected(
+            message, status_code=503, retry_after=max(1.0, self.estimate_wait())
+        )
+
+    def _take_token(self, key: str, rate: float) -> None:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = _TokenBucket(tokens=self.burst_per_key, updated_at=now)
+            self._buckets[key] = bucket
+            while len(self._buckets) > self.max_tracked_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        retry_after = bucket.take(rate, self.burst_per_key, now)
+        if retry_after:
+            self.rate_limited_count += 1
+            raise QueryRejected(
+                "Too many requests", status_code=429, retry_after=retry_after
+            )
+
+    def _abandon(self, key: str, waiter: "asyncio.Future[None]") -> bool:
+        """Stop waiting. Returns False if the waiter was already given a slot."""
+        if waiter.done():
+            return False
+        waiter.cancel()
+        waiters = self._waiters[key]
+        waiters.remove(waiter)
+        self.queue_depth -= 1
+        if not waiters:
+            del self._waiters[key]
+        return True
+
+    def _release(self, service_time: Optional[float]) -> None:
+        if service_time is not None:
+            if self._average_service_time is None:
+                self._average_service_time = service_time
+            else:
+                self._average_service_time += 0.1 * (
+                    service_time - self._average_service_time
+                )
+        # Hand the slot directly to the next waiter, taking users in turn.
+        while self._waiters:
+            key, waiters = self._waiters.popitem(last=False)
+            waiter = waiters.popleft()
+            self.queue_depth -= 1
+            if waiters:
+                self._waiters[key] = waiters
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
@@ -1,20 +1,62 @@
 import argparse
+import asyncio
+import atexit
+import contextlib
+import contextvars
 import copy
+import inspect
 import json
 import logging
+import logging.handlers
+import math
 import os
+import queue
+import random
 import sys
-from typing import Any, AsyncIterable, Dict, Optional, Union
+import time
+from collections import OrderedDict, deque
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+    cast,
+)
 
-from fastapi import Depends, FastAPI, HTTPException, Request, Response
+from fastapi import Depends, FastAPI, Header, HTTPException, Request, Response
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from pydantic import ValidationError
 from sse_starlette.sse import EventSourceResponse, ServerSentEvent
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.background import BackgroundTask
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from typing_extensions import Literal, TypeAlias
 
+from fastapi_poe.admission import (
+    FIRST_RESPONSE_DEADLINE,
+    AdmissionControl,
+    QueryRejected,
+)
+from fastapi_poe.client import API_VERSION, MAX_EVENT_COUNT, MESSAGE_LENGTH_LIMIT
+from fastapi_poe.executor import BotExecutor
+from fastapi_poe.metrics import StreamMetrics, StreamRecorder, render_metrics
+from fastapi_poe.state import ConversationStateStore
+from fastapi_poe.tracing import QueryTrace, SamplingProfiler, _Profile
 from fastapi_poe.types import (
     ContentType,
+    ProtocolMessage,
     QueryRequest,
     ReportErrorRequest,
     ReportFeedbackRequest,
@@ -22,40 +64,135 @@ from fastapi_poe.types import (
     SettingsResponse,
 )
 
+try:
+    import orjson
+
+    _json_loads: Callable[[Union[bytes, str]], Any] = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 logger = logging.getLogger("uvicorn.default")
 
+T = TypeVar("T")
+ResponseLimitPolicy: TypeAlias = Literal["error", "truncate"]
 
-class LoggingMiddleware(BaseHTTPMiddleware):
-    async def set_body(self, request: Request):
-        receive_ = await request._receive()
 
-        async def receive():
-            return receive_
+def _start_queued_logging(target: logging.Logger) -> logging.handlers.QueueListener:
+    """Make *target* hand its records to a background thread.
 
-        request._receive = receive
+    The handlers that would have received the records (including those of parent
+    loggers) are called from that thread instead, so slow log I/O does not block
+    the event loop.
 
-    async def dispatch(self, request: Request, call_next):
-        logger.info(f"Request: {request.method} {request.url}")
-        try:
-            # Per https://github.com/tiangolo/fastapi/issues/394#issuecomment-927272627
-            # to avoid blocking.
-            await self.set_body(request)
-            body = await request.json()
-            logger.debug(f"Request body: {json.dumps(body)}")
-        except json.JSONDecodeError:
-            logger.error("Request body: Unable to parse JSON")
+    """
+    handlers: List[logging.Handler] = []
+    current: Optional[logging.Logger] = target
+    while current is not None:
+        handlers.extend(current.handlers)
+        current = current.parent if current.propagate else None
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
+    target.handlers = [logging.handlers.QueueHandler(log_queue)]
+    target.propagate = False
+    return listener
 
-        response = await call_next(request)
 
-        logger.info(f"Response status: {response.status_code}")
+class LoggingMiddleware:
+    """ASGI middleware that logs one access line per request.
+
+    Streaming responses are passed through as they are produced; at most
+    *max_body_bytes* of each request and response body are kept, and only when
+    debug logging is enabled. Only a *sample_rate* fraction of requests is logged.
+    Records are written to *log* from a background thread.
+
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        *,
+        sample_rate: float = 1.0,
+        max_body_bytes: int = 1024,
+        log: Optional[logging.Logger] = None,
+    ) -> None:
+        self.app = app
+        self.sample_rate = sample_rate
+        self.max_body_bytes = max_body_bytes
+        self.log = log or logging.getLogger("uvicorn.default.access")
+        self._listener_pid: Optional[int] = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or (
+            self.sample_rate < 1 and random.random() >= self.sample_rate
+        ):
+            await self.app(scope, receive, send)
+            return
+        if self._listener_pid != os.getpid():
+            # Started lazily so that each worker process gets its own thread
+            self._listener_pid = os.getpid()
+            _start_queued_logging(self.log)
+
+        log_bodies = self.log.isEnabledFor(logging.DEBUG)
+        request_body = bytearray()
+        response_body = bytearray()
+        status_code = 500
+        request_size = 0
+        response_size = 0
+        first_byte_at: Optional[float] = None
+        started_at = time.monotonic()
+
+        async def logging_receive() -> Message:
+            nonlocal request_size
+            message = await receive()
+            if message["type"] == "http.request":
+                body = message.get("body", b"")
+                request_size += len(body)
+                room = self.max_body_bytes - len(request_body)
+                if log_bodies and room > 0:
+                    request_body.extend(body[:room])
+            return message
+
+        async def logging_send(message: Message) -> None:
+            nonlocal status_code, response_size, first_byte_at
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                first_byte_at = time.monotonic()
+            elif message["type"] == "http.response.body":
+                body = message.get("body", b"")
+                response_size += len(body)
+                room = self.max_body_bytes - len(response_body)
+                if log_bodies and room > 0:
+                    response_body.extend(body[:room])
+            await send(message)
+
         try:
-            if hasattr(response, "body"):
-                body = json.loads(response.body.decode())
-                logger.debug(f"Response body: {json.dumps(body)}")
-        except json.JSONDecodeError:
-            logger.error("Response body: Unable to parse JSON")
+            await self.app(scope, logging_receive, logging_send)
+        finally:
+            now = time.monotonic()
+            first_byte = (first_byte_at or now) - started_at
+            self.log.info(
+                f'{scope["method"]} {scope["path"]} {status_code}'
+                f" {response_size}B first byte {first_byte * 1000:.1f}ms"
+                f" total {(now - started_at) * 1000:.1f}ms"
+            )
+            if log_bodies:
+                self.log.debug(
+                    f"Request body: {_format_body(request_body, request_size)}"
+                )
+                self.log.debug(
+                    f"Response body: {_format_body(response_body, response_size)}"
+                )
+
 
-        return response
+def _format_body(prefix: bytearray, size: int) -> str:
+    text = prefix.decode(errors="replace")
+    if size > len(prefix):
+        text += f"... ({size} bytes)"
+    return text
 
 
 def exception_handler(request: Request, ex: HTTPException):
@@ -63,6 +200,8 @@ def exception_handler(request: Request, ex: HTTPException):
 
 
 http_bearer = HTTPBearer()
+# Sent by clients that reconnect to resume a response, see resumable_streams
+last_event_id_header = Header(None)
 
 
 def auth_user(
@@ -78,11 +217,379 @@ def auth_user(
         )
 
 
+# The protocol requires the full response within 120 seconds
+RESPONSE_DEADLINE = 120.0
+
+
+class Deadline:
+    """The time limits for answering a single query.
+
+    Get the deadline of the query being answered with PoeBot.get_deadline(), e.g.
+    to choose a cheaper strategy when little time is left.
+
+    """
+
+    def __init__(
+        self,
+        *,
+        started_at: Optional[float] = None,
+        first_event_limit: float = FIRST_RESPONSE_DEADLINE,
+        response_limit: float = RESPONSE_DEADLINE,
+    ) -> None:
+        if started_at is None:
+            started_at = time.monotonic()
+        self.started_at = started_at
+        self.first_event_at = started_at + first_event_limit
+        self.response_at = started_at + response_limit
+
+    def first_event_remaining(self) -> float:
+        """Seconds left until the first event must be sent."""
+        return self.first_event_at - time.monotonic()
+
+    def remaining(self) -> float:
+        """Seconds left until the response must be complete."""
+        return self.response_at - time.monotonic()
+
+
+_current_deadline: "contextvars.ContextVar[Optional[Deadline]]" = (
+    contextvars.ContextVar("_current_deadline", default=None)
+)
+
+_current_tasks: "contextvars.ContextVar[Optional[Set[asyncio.Future[Any]]]]" = (
+    contextvars.ContextVar("_current_tasks", default=None)
+)
+
+# The profiler and profile of the query being answered, if it is profiled
+_current_profile: (
+    "contextvars.ContextVar[Optional[Tuple[SamplingProfiler, _Profile]]]"
+) = contextvars.ContextVar("_current_profile", default=None)
+
+# The replay buffer that the response being generated is written to, if any
+_current_replay_buffer: "contextvars.ContextVar[Optional[_ReplayBuffer]]" = (
+    contextvars.ContextVar("_current_replay_buffer", default=None)
+)
+
+# Yielded by _iterate_with_timeouts when no event arrived in time
+_TIMED_OUT = object()
+
+# Kinds of entries passed from the task driving the events to _iterate_with_timeouts
+_EVENT = 0
+_ERROR = 1
+_END = 2
+
+
+async def _iterate_with_timeouts(
+    events: AsyncIterable[ServerSentEvent], get_timeout: Callable[[], Optional[float]]
+) -> AsyncGenerator[object, None]:
+    """Iterate over *events*, yielding _TIMED_OUT while they are slow to arrive.
+
+    Before waiting for each event, get_timeout() is called. If it returns a number
+    and no event arrives within that many seconds, _TIMED_OUT is yielded instead.
+    The events are produced by a single task that runs at most one event ahead, so
+    the wait never interrupts the generator producing them, and cancel scopes,
+    timeouts and context variables in it work as usual.
+
+    """
+    queue: "asyncio.Queue[Tuple[int, Any]]" = asyncio.Queue(1)
+
+    async def drive() -> None:
+        current_profile = _current_profile.get()
+        if current_profile is not None:
+            # The bot runs below this frame rather than the request's
+            profiler, profile = current_profile
+            profiler.add_frame(profile, sys._getframe())
+        try:
+            async for event in events:
+                await queue.put((_EVENT, event))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await queue.put((_ERROR, e))
+        else:
+            await queue.put((_END, None))
+        finally:
+            aclose = getattr(events, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    task = asyncio.ensure_future(drive())
+    try:
+        while True:
+            timeout = get_timeout()
+            if timeout is None:
+                kind, value = await queue.get()
+            elif timeout <= 0:
+                if queue.empty():
+                    yield _TIMED_OUT
+                    continue
+                kind, value = queue.get_nowait()
+            else:
+                try:
+                    kind, value = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    yield _TIMED_OUT
+                    continue
+            if kind == _END:
+                return
+            if kind == _ERROR:
+                raise value
+            yield value
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+class _ReplayBuffer:
+    """The events of a single response, numbered so that a client can resume.
+
+    Events are produced by a background task that is independent of any one
+    connection, and any number of connections can follow the buffer from a given
+    event ID. At most *max_events* of the most recent events are retained. If no
+    connection follows the buffer for *abandon_timeout* seconds while the response
+    is still being generated, the generation is cancelled.
+
+    """
+
+    def __init__(self, max_events: int, abandon_timeout: float) -> None:
+        self.events: Deque[ServerSentEvent] = deque(maxlen=max_events)
+        self.last_id = 0
+        self.done = False
+        self.failed = False
+        # Why the response was cancelled, unless its client went away
+        self.cancel_reason: Optional[str] = None
+        self.finished_at: Optional[float] = None
+        self.task: Optional["asyncio.Task[None]"] = None
+        self.abandon_timeout = abandon_timeout
+        self._followers = 0
+        self._abandon_handle: Optional[asyncio.TimerHandle] = None
+        self._changed = asyncio.Event()
+
+    def start(self, events: AsyncIterable[ServerSentEvent]) -> None:
+        self.task = asyncio.ensure_future(self._fill(events))
+
+    async def _fill(self, events: AsyncIterable[ServerSentEvent]) -> None:
+        _current_replay_buffer.set(self)
+        try:
+            async for event in events:
+                self._append(event)
+        except asyncio.CancelledError:
+            # End the buffered response explicitly, so that it is neither replayed
+            # nor mistaken for a complete one by its followers.
+            self.failed = True
+            self._append(PoeBot.error_event("The response was cancelled"))
+            self._append(PoeBot.done_event())
+            raise
+        finally:
+            self.done = True
+            self.finished_at = time.monotonic()
+            self._notify()
+
+    def _append(self, event: ServerSentEvent) -> None:
+        self.last_id += 1
+        event.id = str(self.last_id)
+        if event.event == "error":
+            self.failed = True
+        self.events.append(event)
+        self._notify()
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def can_resume(self, after_id: int) -> bool:
+        """Whether every event after *after_id* is still available."""
+        first_id = self.last_id - len(self.events) + 1
+        return first_id - 1 <= after_id <= self.last_id
+
+    async def follow(self, after_id: int = 0) -> AsyncIterator[ServerSentEvent]:
+        """Yield events after *after_id*, waiting for new ones until the end.
+
+        A reader that falls behind the retained events gets an error event that
+        does not allow retries, followed by a done event.
+
+        """
+        self._followers += 1
+        if self._abandon_handle is not None:
+            self._abandon_handle.cancel()
+            self._abandon_handle = None
+        try:
+            next_id = after_id + 1
+            while True:
+                first_id = self.last_id - len(self.events) + 1
+                if next_id < first_id:
+                    # The reader fell behind the retained window, so the rest of
+                    # its response is lost.
+                    yield PoeBot.error_event(
+                        "The response is no longer available", allow_retry=False
+                    )
+                    yield PoeBot.done_event()
+                    return
+                while next_id <= self.last_id:
+                    yield self.events[next_id - first_id]
+                    next_id += 1
+                if self.done:
+                    return
+                await self._changed.wait()
+        finally:
+            self._followers -= 1
+            if not self._followers and not self.done:
+                self._abandon_handle = asyncio.get_event_loop().call_later(
+                    self.abandon_timeout, self.cancel
+                )
+
+    def cancel(self, reason: Optional[str] = None) -> None:
+        if self.task is not None and not self.task.done():
+            # Also covers a task cancelled before it started running
+            self.failed = True
+            self.cancel_reason = reason
+            self.task.cancel()
+
+
+# Length of the JSON wrapping the text in a text event, see PoeBot.text_event()
+_TEXT_EVENT_OVERHEAD = len(json.dumps({"text": ""}))
+
+
+def _get_text_length(data: str) -> int:
+    """Length of the text in the data of a text or replace_response event."""
+    # Data produced by text_event() without escapes can be measured without
+    # decoding it.
+    if (
+        data.startswith('{"text": "')
+        and data.endswith('"}')
+        and "\\" not in data
+        and data.count('"') == 4
+    ):
+        return len(data) - _TEXT_EVENT_OVERHEAD
+    return len(json.loads(data)["text"])
+
+
+def _record_event(recorder: StreamRecorder, event: ServerSentEvent) -> None:
+    if event.event == "text":
+        # Only events with escapes in their text are decoded
+        recorder.record_event(_get_text_length(cast(str, event.data)))
+    else:
+        recorder.record_event()
+        if event.event == "error":
+            recorder.record_error("error_event")
+
+
+def _with_refetch_settings(event: ServerSentEvent) -> ServerSentEvent:
+    data = json.loads(cast(str, event.data))
+    data["refetch_settings"] = True
+    return ServerSentEvent(data=json.dumps(data), event=event.event, id=event.id)
+
+
 class PoeBot:
+    # Set text_coalesce_window to a number of seconds to merge consecutive text events
+    # produced within that window into a single SSE frame. A merged frame is flushed
+    # early once its payload reaches text_coalesce_max_bytes.
+    text_coalesce_window: Optional[float] = None
+    text_coalesce_max_bytes: int = 4096
+
+    # Number of SSE frames saved by text coalescing since the bot was created
+    coalesced_frame_count: int = 0
+
+    # Set resumable_streams to number the events of each response and keep the
+    # most recent responses in memory. A client whose connection breaks can then
+    # retry with a Last-Event-ID header and receive only the events it missed,
+    # without the response being generated again.
+    resumable_streams: bool = False
+    replay_buffer_max_events: int = 1000
+    replay_buffer_max_messages: int = 100
+    # Seconds for which a finished response is kept in the replay buffer
+    replay_buffer_ttl: float = 600.0
+    # Seconds to keep generating a response nobody is receiving, waiting for the
+    # client to reconnect
+    replay_buffer_abandon_timeout: float = 10.0
+    _replay_buffers: "Optional[OrderedDict[str, _ReplayBuffer]]" = None
+
+    # Set deduplicate_queries to answer a repeated query for a message_id that is
+    # still being answered, or was answered successfully within replay_buffer_ttl,
+    # from the replay buffer instead of calling get_response again.
+    deduplicate_queries: bool = False
+
+    # Number of queries answered from the replay buffer since the bot was created
+    deduplicated_query_count: int = 0
+    # Number of requests with a Last-Event-ID whose response was no longer buffered
+    failed_resume_count: int = 0
+
+    # Number of responses stopped early because the client went away
+    aborted_stream_count: int = 0
+    # Number of responses stopped early because their replay buffer was replaced by
+    # a new query for the same message or evicted
+    evicted_stream_count: int = 0
+
+    # Set enforce_deadlines to keep responses within the protocol's time limits: an
+    # early meta event is sent if the bot is slow to start, and the response is cut
+    # off with an error event if it runs too long. Both happen deadline_margin
+    # seconds before the actual limit.
+    enforce_deadlines: bool = False
+    deadline_margin: float = 1.0
+
+    # Set lazy_query to validate the messages of a query only when get_response()
+    # accesses them; query.query is then a LazyProtocolMessages. Setting
+    # query_window_messages or query_window_chars implies lazy_query and drops all
+    # but the most recent messages within those limits.
+    lazy_query: bool = False
+    query_window_messages: Optional[int] = None
+    query_window_chars: Optional[int] = None
+
+    # Set conversation_state_store to use get_conversation_state() and
+    # save_conversation_state(), e.g. to InMemoryStateStore() or SQLiteStateStore().
+    # If the store has no ttl, it is set to the bot's context_clear_window_secs.
+    conversation_state_store: Optional[ConversationStateStore] = None
+    _state_ttl_resolved: bool = False
+
+    # Set response_limit_policy to keep responses within the protocol's limits of
+    # MESSAGE_LENGTH_LIMIT characters of text and MAX_EVENT_COUNT events. The bot
+    # is stopped as soon as it would exceed one. With "error", an error event is
+    # sent in place of the rest of the response. With "truncate", the response
+    # text is cut off at the limit and the response ends normally.
+    response_limit_policy: Optional[ResponseLimitPolicy] = None
+
+    # Number of responses stopped by response_limit_policy since the bot was created
+    limited_response_count: int = 0
+
+    # Set collect_metrics to record latency histograms and counts for the responses
+    # of this bot. make_app(metrics=True) sets it and serves them at /metrics.
+    collect_metrics: bool = False
+    _metrics: Optional[StreamMetrics] = None
+
+    # Blocking calls made with run_sync(), synchronous generators passed to
+    # iterate_sync() and get_response() implementations that are synchronous
+    # generators run on a pool of at most thread_pool_size threads. A generator
+    # runs at most sync_buffer_size events ahead of the client.
+    thread_pool_size: int = 8
+    sync_buffer_size: int = 16
+    _executor: Optional[BotExecutor] = None
+
+    # Set profile_every to profile one in that many queries with a sampling
+    # profiler. The stacks seen while answering a query are written in the collapsed
+    # format (for flamegraph tools) to a file in profile_dir. Samples are taken
+    # every profile_interval seconds.
+    profile_every: Optional[int] = None
+    profile_dir: str = "profiles"
+    profile_interval: float = 0.005
+    _query_count_since_profile: int = 0
+    _profiler: Optional[SamplingProfiler] = None
+
+    # Set cache_settings to call get_settings() only once and serve its encoded
+    # result for all settings requests, until invalidate_settings() is called.
+    cache_settings: bool = False
+    _settings_cache: Optional[bytes] = None
+    # Set by invalidate_settings() until Poe fetches the settings again. Meanwhile
+    # responses set refetch_settings in their meta event.
+    _settings_refetch_pending: bool = False
+
     # Override these for your bot
 
     async def get_response(self, query: QueryRequest) -> AsyncIterable[ServerSentEvent]:
-        """Override this to return a response to user queries."""
+        """Override this to return a response to user queries.
+
+        This may also be a synchronous generator, which is then run on the bot's
+        thread pool (see thread_pool_size).
+
+        """
         yield self.text_event("hello")
 
     async def get_settings(self, setting: SettingsRequest) -> SettingsResponse:
@@ -97,8 +604,120 @@ class PoeBot:
         """Override this to record errors from the Poe server."""
         logger.error(f"Error from Poe server: {error_request}")
 
+    # Override these to trace queries. They are called synchronously from the
+    # request handler, so they should be quick; the trace they receive records
+    # where the time of the query went.
+
+    def on_before_parse(self, request: Dict[str, Any], trace: QueryTrace) -> None:
+        """Called with the decoded body of a query request before it is parsed."""
+        pass
+
+    def on_first_event(
+        self, query: QueryRequest, event: ServerSentEvent, trace: QueryTrace
+    ) -> None:
+        """Called when the first event of a response is about to be sent."""
+        pass
+
+    def on_event(
+        self, query: QueryRequest, event: ServerSentEvent, trace: QueryTrace
+    ) -> None:
+        """Called for every event of a response, before it is sent."""
+        pass
+
+    def on_done(self, query: QueryRequest, trace: QueryTrace) -> None:
+        """Called when a response has finished, failed or been stopped."""
+        pass
+
     # Helpers for generating responses
 
+    @staticmethod
+    def get_deadline() -> Deadline:
+        """Return the deadline of the query being answered.
+
+        Call this from get_response().
+
+        """
+        deadline = _current_deadline.get()
+        if deadline is None:
+            raise RuntimeError("get_deadline() called outside of a query")
+        return deadline
+
+    @staticmethod
+    def register_task(task: "asyncio.Future[Any]") -> "asyncio.Future[Any]":
+        """Tie a task started by get_response() to the query being answered.
+
+        The task is cancelled if it is still running when the response ends, e.g.
+        because the client disconnected. Returns the task.
+
+        """
+        tasks = _current_tasks.get()
+        if tasks is None:
+            raise RuntimeError("register_task() called outside of a query")
+        tasks.add(task)
+        return task
+
+    async def get_conversation_state(
+        self, query: QueryRequest
+    ) -> Tuple[Optional[Any], Sequence[ProtocolMessage]]:
+        """Return the state saved for this conversation and the messages since.
+
+        The state is the one saved by save_conversation_state() for the longest
+        prefix of query.query, or None if there is none. The messages are those
+        after that prefix, i.e. all of them if there is no saved state.
+
+        """
+        store = await self._get_conversation_state_store()
+        cached = await store.get(query.conversation_id, query.query)
+        if cached is None:
+            return None, query.query
+        count = cached.message_count
+        return cached.state, query.query[count:]
+
+    async def save_conversation_state(self, query: QueryRequest, state: Any) -> None:
+        """Save *state* as derived from all messages in query.query."""
+        store = await self._get_conversation_state_store()
+        await store.put(query.conversation_id, query.query, state)
+
+    def get_metrics(self) -> StreamMetrics:
+        """Return the metrics recorded for this bot's responses."""
+        if self._metrics is None:
+            self._metrics = StreamMetrics(side="server", bot=type(self).__name__)
+        return self._metrics
+
+    async def _get_conversation_state_store(self) -> ConversationStateStore:
+        store = self.conversation_state_store
+        if store is None:
+            raise RuntimeError("No conversation_state_store is set")
+        if not self._state_ttl_resolved:
+            self._state_ttl_resolved = True
+            if store.ttl is None:
+                # Poe starts a new context after this long, so older state is unused
+                settings = await self.get_settings(
+                    SettingsRequest(version=API_VERSION, type="settings")
+                )
+                if settings.context_clear_window_secs is not None:
+                    store.ttl = settings.context_clear_window_secs
+        return store
+
+    def get_executor(self) -> BotExecutor:
+        """Return the thread pool used for synchronous code."""
+        if self._executor is None:
+            self._executor = BotExecutor(self.thread_pool_size)
+        return self._executor
+
+    async def run_sync(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Call a blocking function on the bot's thread pool and return its result.
+
+        Use this from get_response() for blocking calls, e.g. to a synchronous
+        model API, so that other responses keep streaming meanwhile.
+
+        """
+        return await self.get_executor().run(func, *args, **kwargs)
+
+    def iterate_sync(self, iterable: Iterable[T]) -> AsyncGenerator[T, None]:
+        """Iterate over a blocking iterable on the bot's thread pool."""
+        return self.get_executor().iterate(iterable, buffer_size=self.sync_buffer_size)
+
     @staticmethod
     def text_event(text: str) -> ServerSentEvent:
         return ServerSentEvent(data=json.dumps({"text": text}), event="text")
@@ -137,6 +756,15 @@ class PoeBot:
             event="meta",
         )
 
+    def early_meta_event(self) -> ServerSentEvent:
+        """Meta event sent for a bot that is slow to start, see enforce_deadlines.
+
+        It uses the protocol's defaults, which apply when no meta event is sent.
+        Override this if your bot sends a meta event with different values.
+
+        """
+        return self.meta_event(linkify=False, suggested_replies=False)
+
     @staticmethod
     def error_event(
         text: Optional[str] = None, *, allow_retry: bool = True
@@ -160,19 +788,371 @@ class PoeBot:
         await self.on_error(error_request)
         return JSONResponse({})
 
-    async def handle_settings(self, settings_request: SettingsRequest) -> JSONResponse:
-        settings = await self.get_settings(settings_request)
-        return JSONResponse(settings.dict())
+    async def handle_settings(self, settings_request: SettingsRequest) -> Response:
+        self._settings_refetch_pending = False
+        if not self.cache_settings:
+            settings = await self.get_settings(settings_request)
+            return JSONResponse(settings.dict())
+        if self._settings_cache is None:
+            settings = await self.get_settings(settings_request)
+            self._settings_cache = bytes(JSONResponse(settings.dict()).body)
+        return Response(self._settings_cache, media_type="application/json")
+
+    def invalidate_settings(self) -> None:
+        """Call this when get_settings() would return something different.
+
+        Drops the cached settings, and asks Poe to fetch the settings again by
+        setting refetch_settings in the meta event of responses until it does.
+
+        """
+        self._settings_cache = None
+        self._settings_refetch_pending = True
+
+    async def _request_settings_refetch(
+        self, events: AsyncIterable[ServerSentEvent]
+    ) -> AsyncIterator[ServerSentEvent]:
+        """Set refetch_settings in the meta event, adding one if there is none."""
+        first = True
+        async for event in events:
+            if first:
+                first = False
+                if event.event != "meta":
+                    yield _with_refetch_settings(self.early_meta_event())
+                else:
+                    event = _with_refetch_settings(event)
+            yield event
+
+    async def _coalesce_text_events(
+        self, events: AsyncIterable[ServerSentEvent], window: float
+    ) -> AsyncIterator[ServerSentEvent]:
+        """Merge runs of consecutive text events.
 
-    async def handle_query(self, query: QueryRequest) -> AsyncIterable[ServerSentEvent]:
+        Events other than text events are never merged and act as a barrier: any
+        buffered text is flushed before them, so the relative order of events is
+        preserved.
+
+        """
+        buffer: List[str] = []
+        buffered_bytes = 0
+        deadline = 0.0
+
+        def get_timeout() -> Optional[float]:
+            return deadline - time.monotonic() if buffer else None
+
+        def flush() -> ServerSentEvent:
+            nonlocal buffered_bytes
+            self.coalesced_frame_count += len(buffer) - 1
+            event = self.text_event("".join(buffer))
+            buffer.clear()
+            buffered_bytes = 0
+            return event
+
+        iterator = _iterate_with_timeouts(events, get_timeout)
         try:
-            async for event in self.get_response(query):
+            async for item in iterator:
+                if item is _TIMED_OUT:
+                    yield flush()
+                    continue
+                event = cast(ServerSentEvent, item)
+                if event.event != "text":
+                    if buffer:
+                        yield flush()
+                    yield event
+                    continue
+                if not buffer:
+                    deadline = time.monotonic() + window
+                data = cast(str, event.data)
+                buffer.append(json.loads(data)["text"])
+                buffered_bytes += len(data)
+                if buffered_bytes >= self.text_coalesce_max_bytes:
+                    yield flush()
+        except Exception:
+            if buffer:
+                yield flush()
+            raise
+        finally:
+            await iterator.aclose()
+        if buffer:
+            yield flush()
+
+    async def _enforce_deadline(
+        self, events: AsyncIterable[ServerSentEvent], deadline: Deadline
+    ) -> AsyncIterator[ServerSentEvent]:
+        """Keep the response within the protocol's time limits.
+
+        If the bot has sent nothing shortly before the first-event limit, an early
+        meta event is sent for it. If it is still responding shortly before the
+        overall limit, it is stopped and an error event is sent instead.
+
+        The bot's generator runs in one task for the whole response, so cancel
+        scopes and timeouts it holds across a yield behave as without deadlines.
+        Stopping the bot cancels that task.
+
+        """
+        started = False
+
+        def get_timeout() -> float:
+            if not started:
+                return deadline.first_event_remaining() - self.deadline_margin
+            return deadline.remaining() - self.deadline_margin
+
+        iterator = _iterate_with_timeouts(events, get_timeout)
+        try:
+            async for item in iterator:
+                if item is not _TIMED_OUT:
+                    started = True
+                    yield cast(ServerSentEvent, item)
+                elif not started:
+                    started = True
+                    yield self.early_meta_event()
+                else:
+                    logger.warning("Response deadline reached, stopping the bot")
+                    yield self.error_event(
+                        "Bot took too long to respond", allow_retry=False
+                    )
+                    return
+        finally:
+            await iterator.aclose()
+
+    async def _enforce_response_limits(
+        self, events: AsyncIterable[ServerSentEvent], policy: ResponseLimitPolicy
+    ) -> AsyncIterator[ServerSentEvent]:
+        """Stop the response before it exceeds the protocol's limits."""
+        truncate = policy == "truncate"
+        # Leave room for the done event, and the error event if there is one
+        max_events = MAX_EVENT_COUNT - (1 if truncate else 2)
+        event_count = 0
+        text_length = 0
+        try:
+            async for event in events:
+                if event_count >= max_events:
+                    self.limited_response_count += 1
+                    logger.warning("Response has too many events, stopping the bot")
+                    if not truncate:
+                        yield self.error_event(
+                            "Bot returned too many events", allow_retry=False
+                        )
+                    return
+                if event.event == "text" or event.event == "replace_response":
+                    if event.event == "replace_response":
+                        text_length = 0
+                    length = _get_text_length(cast(str, event.data))
+                    if text_length + length > MESSAGE_LENGTH_LIMIT:
+                        self.limited_response_count += 1
+                        logger.warning("Response has too much text, stopping the bot")
+                        if not truncate:
+                            yield self.error_event(
+                                "Bot returned too much text", allow_retry=False
+                            )
+                        elif text_length < MESSAGE_LENGTH_LIMIT:
+                            text = json.loads(cast(str, event.data))["text"]
+                            yield ServerSentEvent(
+                                data=json.dumps(
+                                    {"text": text[: MESSAGE_LENGTH_LIMIT - text_length]}
+                                ),
+                                event=event.event,
+                                id=event.id,
+                            )
+                        return
+                    text_length += length
+                event_count += 1
                 yield event
+        finally:
+            aclose = getattr(events, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    async def handle_query(
+        self,
+        query: QueryRequest,
+        deadline: Optional[Deadline] = None,
+        trace: Optional[QueryTrace] = None,
+    ) -> AsyncGenerator[ServerSentEvent, None]:
+        if deadline is None:
+            deadline = Deadline()
+        _current_deadline.set(deadline)
+        tasks: Set["asyncio.Future[Any]"] = set()
+        _current_tasks.set(tasks)
+        events = self.get_response(query)
+        if inspect.isgenerator(events):
+            events = self.iterate_sync(events)
+        if self.enforce_deadlines:
+            events = self._enforce_deadline(events, deadline)
+        if self._settings_refetch_pending:
+            events = self._request_settings_refetch(events)
+        if self.text_coalesce_window is not None:
+            events = self._coalesce_text_events(events, self.text_coalesce_window)
+        if self.response_limit_policy is not None:
+            events = self._enforce_response_limits(events, self.response_limit_policy)
+        recorder = None
+        if self.collect_metrics:
+            recorder = self.get_metrics().start(deadline.started_at)
+        profile = None
+        if self.profile_every is not None:
+            self._query_count_since_profile += 1
+            if self._query_count_since_profile >= self.profile_every:
+                self._query_count_since_profile = 0
+                if trace is None:
+                    trace = QueryTrace(received_at=deadline.started_at)
+                profile = self._start_profile(query, trace)
+                assert self._profiler is not None
+                _current_profile.set((self._profiler, profile))
+        if profile is None and not self._has_trace_hooks():
+            # Skip the per-event timing when nobody looks at it
+            trace = None
+        elif trace is None:
+            trace = QueryTrace(received_at=deadline.started_at)
+        try:
+            resumed_at = time.monotonic()
+            async for event in events:
+                if recorder is not None:
+                    _record_event(recorder, event)
+                if trace is not None:
+                    now = time.monotonic()
+                    trace.response_time += now - resumed_at
+                    trace.event_count += 1
+                    if trace.first_event_at is None:
+                        trace.first_event_at = now
+                        self.on_first_event(query, event, trace)
+                    self.on_event(query, event, trace)
+                    yield event
+                    resumed_at = time.monotonic()
+                    trace.send_time += resumed_at - now
+                else:
+                    yield event
         except Exception as e:
             logger.exception("Error responding to query")
+            if recorder is not None:
+                recorder.record_error(type(e).__name__)
+            if trace is not None:
+                trace.error = e
             yield self.error_event(repr(e), allow_retry=False)
+        except (asyncio.CancelledError, GeneratorExit) as e:
+            buffer = _current_replay_buffer.get()
+            if buffer is not None and buffer.cancel_reason is not None:
+                self.evicted_stream_count += 1
+                logger.info(
+                    "Replay buffer was %s, stopping the response", buffer.cancel_reason
+                )
+                if recorder is not None:
+                    recorder.record_error(f"replay_buffer_{buffer.cancel_reason}")
+            else:
+                self.aborted_stream_count += 1
+                logger.info("Client went away, stopping the response")
+                if recorder is not None:
+                    recorder.record_error("client_disconnected")
+            if trace is not None:
+                trace.error = e
+            raise
+        finally:
+            aclose = getattr(events, "aclose", None)
+            if aclose is not None:
+                await aclose()
+            for task in tasks:
+                task.cancel()
+            if recorder is not None:
+                recorder.finish()
+            if profile is not None and self._profiler is not None:
+                self._profiler.stop(profile)
+            if trace is not None:
+                trace.finished_at = time.monotonic()
+                self.on_done(query, trace)
         yield self.done_event()
 
+    def _has_trace_hooks(self) -> bool:
+        cls = type(self)
+        return (
+            cls.on_first_event is not PoeBot.on_first_event
+            or cls.on_event is not PoeBot.on_event
+            or cls.on_done is not PoeBot.on_done
+        )
+
+    def _start_profile(self, query: QueryRequest, trace: QueryTrace) -> _Profile:
+        if self._profiler is None:
+            self._profiler = SamplingProfiler(self.profile_interval)
+        filename = f"{int(time.time() * 1000)}-{os.getpid()}-{query.message_id}"
+        # Message IDs come from the request, so keep them out of the path
+        filename = "".join(c if c.isalnum() or c in "-_" else "_" for c in filename)
+        trace.profile_path = os.path.join(self.profile_dir, filename + ".collapsed")
+        return self._profiler.start(sys._getframe(1), trace.profile_path)
+
+    async def handle_resumable_query(
+        self,
+        query: QueryRequest,
+        last_event_id: Optional[str] = None,
+        deadline: Optional[Deadline] = None,
+        trace: Optional[QueryTrace] = None,
+    ) -> AsyncGenerator[ServerSentEvent, None]:
+        """Like handle_query, but serves the response through the replay buffer.
+
+        If *last_event_id* refers to a response to this message that is still in
+        the replay buffer, only the later events are sent; if it is no longer
+        there, e.g. because it was evicted or is held by another worker process, an
+        error event is sent. With deduplicate_queries, a query without
+        *last_event_id* for a message that is in the replay buffer gets the whole
+        buffered response. Otherwise the response is generated from scratch.
+
+        """
+        if self._replay_buffers is None:
+            self._replay_buffers = OrderedDict()
+        buffers = self._replay_buffers
+        self._evict_expired_replay_buffers(buffers)
+        buffer = buffers.get(query.message_id)
+        after_id: Optional[int] = None
+        if last_event_id is not None:
+            with contextlib.suppress(ValueError):
+                after_id = int(last_event_id)
+            if buffer is None or after_id is None or not buffer.can_resume(after_id):
+                # Generating the response again would send the client text it
+                # already has, so tell it that the response is lost instead.
+                self.failed_resume_count += 1
+                logger.info("Cannot resume a response that is no longer buffered")
+                yield self.error_event(
+                    "Cannot resume the response, it is no longer available",
+                    allow_retry=False,
+                )
+                yield self.done_event()
+                return
+        elif (
+            buffer is not None
+            and self.deduplicate_queries
+            and not buffer.failed
+            and buffer.can_resume(0)
+        ):
+            self.deduplicated_query_count += 1
+            after_id = 0
+        if buffer is not None and after_id is not None:
+            buffers.move_to_end(query.message_id)
+            async for event in buffer.follow(after_id):
+                yield event
+            return
+
+        buffer = _ReplayBuffer(
+            self.replay_buffer_max_events, self.replay_buffer_abandon_timeout
+        )
+        old_buffer = buffers.pop(query.message_id, None)
+        if old_buffer is not None:
+            old_buffer.cancel("replaced")
+        buffers[query.message_id] = buffer
+        while len(buffers) > self.replay_buffer_max_messages:
+            _, evicted = buffers.popitem(last=False)
+            evicted.cancel("evicted")
+        buffer.start(self.handle_query(query, deadline, trace))
+        async for event in buffer.follow():
+            yield event
+
+    def _evict_expired_replay_buffers(
+        self, buffers: "OrderedDict[str, _ReplayBuffer]"
+    ) -> None:
+        cutoff = time.monotonic() - self.replay_buffer_ttl
+        expired = [
+            message_id
+            for message_id, buffer in buffers.items()
+            if buffer.finished_at is not None and buffer.finished_at < cutoff
+        ]
+        for message_id in expired:
+            del buffers[message_id]
+
 
 def find_auth_key(api_key: str, *, allow_without_key: bool = False) -> Optional[str]:
     if not api_key:
@@ -196,8 +1176,73 @@ def find_auth_key(api_key: str, *, allow_without_key: bool = False) -> Optional[
     return api_key
 
 
+# AdmissionControl.get_stats() keys exposed at /metrics
+_ADMISSION_METRICS = (
+    ("in_flight", "admission_in_flight", "gauge", "Queries holding a slot."),
+    ("queue_depth", "admission_queue_depth", "gauge", "Queries waiting for a slot."),
+    (
+        "estimated_wait_seconds",
+        "admission_estimated_wait_seconds",
+        "gauge",
+        "Estimated wait for a slot.",
+    ),
+    ("admitted", "admission_admitted_total", "counter", "Queries admitted."),
+    (
+        "queued",
+        "admission_queued_total",
+        "counter",
+        "Queries that had to wait for a slot.",
+    ),
+    (
+        "rejected_overload",
+        "admission_rejected_overload_total",
+        "counter",
+        "Queries rejected with 503.",
+    ),
+    (
+        "rejected_rate_limited",
+        "admission_rejected_rate_limited_total",
+        "counter",
+        "Queries rejected with 429.",
+    ),
+    (
+        "average_wait_seconds",
+        "admission_average_wait_seconds",
+        "gauge",
+        "Average wait of queued queries.",
+    ),
+    (
+        "max_wait_seconds",
+        "admission_max_wait_seconds",
+        "gauge",
+        "Longest wait of a queued query.",
+    ),
+)
+
+
+# BotExecutor.get_stats() keys exposed at /metrics
+_EXECUTOR_METRICS = (
+    ("max_workers", "executor_max_workers", "gauge", "Threads in the bot's pool."),
+    ("busy", "executor_busy", "gauge", "Threads running synchronous bot code."),
+    ("queued", "executor_queued", "gauge", "Calls waiting for a free thread."),
+    ("completed", "executor_completed_total", "counter", "Calls completed."),
+    (
+        "total_wait_seconds",
+        "executor_wait_seconds_total",
+        "counter",
+        "Time calls spent waiting for a free thread.",
+    ),
+)
+
+
 def make_app(
-    bot: PoeBot, api_key: str = "", *, allow_without_key: bool = False
+    bot: PoeBot,
+    api_key: str = "",
+    *,
+    allow_without_key: bool = False,
+    admission_control: Optional[AdmissionControl] = None,
+    fast_path: bool = False,
+    metrics: bool = False,
 ) -> FastAPI:
     """Create an app object. Arguments are as for run()."""
     app = FastAPI()
@@ -215,16 +1260,113 @@ def make_app(
             f' href="{url}">{url}</a>.</p></body></html>'
         )
 
-    @app.post("/")
-    async def poe_post(request: Dict[str, Any], dict=Depends(auth_user)) -> Response:
+    if metrics:
+        bot.collect_metrics = True
+
+        @app.get("/metrics")
+        async def get_metrics() -> Response:
+            extra: List[Tuple[str, str, str, float]] = [
+                (
+                    "aborted_streams_total",
+                    "counter",
+                    "Responses stopped because the client went away.",
+                    bot.aborted_stream_count,
+                ),
+                (
+                    "evicted_streams_total",
+                    "counter",
+                    "Responses stopped because their replay buffer was replaced or evicted.",
+                    bot.evicted_stream_count,
+                ),
+                (
+                    "coalesced_frames_total",
+                    "counter",
+                    "SSE frames saved by text coalescing.",
+                    bot.coalesced_frame_count,
+                ),
+                (
+                    "limited_responses_total",
+                    "counter",
+                    "Responses stopped to stay within the protocol's limits.",
+                    bot.limited_response_count,
+                ),
+                (
+                    "deduplicated_queries_total",
+                    "counter",
+                    "Queries answered from the replay buffer.",
+                    bot.deduplicated_query_count,
+                ),
+                (
+                    "failed_resumes_total",
+                    "counter",
+                    "Resumed requests whose response was no longer buffered.",
+                    bot.failed_resume_count,
+                ),
+            ]
+            if bot._executor is not None:
+                stats = bot._executor.get_stats()
+                for key, name, kind, help in _EXECUTOR_METRICS:
+                    extra.append((name, kind, help, stats[key]))
+            if admission_control is not None:
+                stats = admission_control.get_stats()
+                for key, name, kind, help in _ADMISSION_METRICS:
+                    extra.append((name, kind, help, stats[key]))
+            return PlainTextResponse(
+                render_metrics(extra), media_type="text/plain; version=0.0.4"
+            )
+
+    async def handle_request(
+        request: Dict[str, Any], last_event_id: Optional[str]
+    ) -> Response:
         if request["type"] == "query":
-            return EventSourceResponse(
-                bot.handle_query(
-                    QueryRequest.parse_obj(
-                        {**request, "api_key": auth_key or "<missing>"}
-                    )
+            # The time limits start counting when the request arrives, not when we
+            # start working on it.
+            deadline = Deadline()
+            trace = QueryTrace(received_at=deadline.started_at)
+            bot.on_before_parse(request, trace)
+            request["api_key"] = auth_key or "<missing>"
+            if (
+                bot.lazy_query
+                or bot.query_window_messages is not None
+                or bot.query_window_chars is not None
+            ):
+                query = QueryRequest.parse_lazy(
+                    request,
+                    max_messages=bot.query_window_messages,
+                    max_chars=bot.query_window_chars,
                 )
-            )
+            else:
+                query = QueryRequest.parse_obj(request)
+            trace.parsed_at = time.monotonic()
+            if bot.resumable_streams or bot.deduplicate_queries:
+                events = bot.handle_resumable_query(
+                    query, last_event_id, deadline, trace
+                )
+            else:
+                events = bot.handle_query(query, deadline, trace)
+            ticket = None
+            if admission_control is not None:
+                try:
+                    ticket = await admission_control.acquire(query)
+                except QueryRejected as e:
+                    headers = None
+                    if e.retry_after is not None:
+                        headers = {"Retry-After": str(math.ceil(e.retry_after))}
+                    raise HTTPException(
+                        status_code=e.status_code, detail=str(e), headers=headers
+                    ) from e
+            stream = events if ticket is None else ticket.wrap(events)
+
+            async def finish() -> None:
+                # Runs once the response has ended, including when the client
+                # disconnected. Closing the generators right away stops the bot
+                # instead of leaving it running until they are garbage collected.
+                await stream.aclose()
+                await events.aclose()
+                if ticket is not None:
+                    ticket.release()
+
+            return EventSourceResponse(stream, background=BackgroundTask(finish))
         elif request["type"] == "settings":
             return await bot.handle_settings(SettingsRequest.parse_obj(request))
         elif request["type"] == "report_feedback":
@@ -236,12 +1378,59 @@ def make_app(
         else:
             raise HTTPException(status_code=501, detail="Unsupported request type")
 
-    # Uncomment this line to print out request and response
-    # app.add_middleware(LoggingMiddleware)
+    if fast_path:
+
+        async def poe_post_fast(http_request: Request) -> Response:
+            # Authenticate with the same checks as the default route and decode the
+            # body once, skipping FastAPI's dependency injection and validation of
+            # the raw body.
+            authorization = await http_bearer(http_request)
+            assert authorization is not None  # HTTPBearer raises instead
+            auth_user(authorization)
+            try:
+                request = _json_loads(await http_request.body())
+            except ValueError:
+                return JSONResponse({"detail": "Invalid JSON"}, status_code=400)
+            if not isinstance(request, dict) or "type" not in request:
+                return JSONResponse({"detail": "Invalid request"}, status_code=400)
+            try:
+                return await handle_request(
+                    request, http_request.headers.get("last-event-id")
+                )
+            except ValidationError as e:
+                return JSONResponse({"detail": str(e)}, status_code=422)
+
+        app.router.add_route("/", poe_post_fast, methods=["POST"])
+    else:
+
+        @app.post("/")
+        async def poe_post(
+            request: Dict[str, Any],
+            dict=Depends(auth_user),
+            last_event_id: Optional[str] = last_event_id_header,
+        ) -> Response:
+            return await handle_request(request, last_event_id)
+
+    # Uncomment this line to log each request, and its body at debug level
+    # app.add_middleware(LoggingMiddleware, sample_rate=1.0)
     return app
 
 
-def run(bot: PoeBot, api_key: str = "", *, allow_without_key: bool = False) -> None:
+def run(
+    bot: PoeBot,
+    api_key: str = "",
+    *,
+    allow_without_key: bool = False,
+    admission_control: Optional[AdmissionControl] = None,
+    fast_path: bool = False,
+    metrics: bool = False,
+    workers: int = 1,
+    reuse_port: bool = False,
+    loop: str = "auto",
+    http: str = "auto",
+    timeout_keep_alive: int = 5,
+    backlog: int = 2048,
+) -> None:
     """
     Run a Poe bot server using FastAPI.
 
@@ -252,24 +1441,68 @@ def run(bot: PoeBot, api_key: str = "", *, allow_without_key: bool = False) -> N
     :param allow_without_key: If True, the server will start even if no API key
     is provided. Requests will not be checked against any key. If an API key
     is provided, it is still checked.
+    :param admission_control: If provided, limits how many queries are answered
+    concurrently, queueing or rejecting the rest. See AdmissionControl.
+    :param fast_path: If True, requests are served by a plain Starlette endpoint
+    that checks the API key and decodes the JSON body only once (with orjson if it
+    is installed), instead of going through FastAPI's body parsing and dependency
+    injection. This is faster for queries with long conversations.
+    :param metrics: If True, the bot records latency histograms and counts for its
+    responses, which are served in the Prometheus text format at /metrics. The
+    route does not require the API key. Metrics of PoeClients created with
+    collect_metrics=True are included too.
+    :param workers: Number of worker processes to serve requests from. Each worker
+    has its own copy of the bot, so in-memory state (and admission control limits)
+    are per worker. Can be overridden with --workers.
+    :param reuse_port: Give each worker its own listening socket bound with
+    SO_REUSEPORT, so the kernel balances connections between them.
+    :param loop: Event loop for uvicorn: "auto" (uvloop if installed), "asyncio"
+    or "uvloop".
+    :param http: HTTP implementation for uvicorn: "auto" (httptools if installed),
+    "h11" or "httptools".
+    :param timeout_keep_alive: Seconds to keep idle connections open.
+    :param backlog: Maximum number of connections waiting to be accepted.
+
+    Send SIGHUP to the server to restart its workers one at a time.
 
     """
 
-    app = make_app(bot, api_key, allow_without_key=allow_without_key)
+    app = make_app(
+        bot,
+        api_key,
+        allow_without_key=allow_without_key,
+        admission_control=admission_control,
+        fast_path=fast_path,
+        metrics=metrics,
+    )
 
     parser = argparse.ArgumentParser("FastAPI sample Poe bot server")
     parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("-w", "--workers", type=int, default=workers)
     args = parser.parse_args()
     port = args.port
 
     logger.info("Starting")
     import uvicorn.config
 
+    from fastapi_poe.workers import serve
+
     log_config = copy.deepcopy(uvicorn.config.LOGGING_CONFIG)
     log_config["formatters"]["default"][
         "fmt"
     ] = "%(asctime)s - %(levelname)s - %(message)s"
-    uvicorn.run(app, host="0.0.0.0", port=port, log_config=log_config)
+    serve(
+        app,
+        host="0.0.0.0",
+        port=port,
+        workers=args.workers,
+        reuse_port=reuse_port,
+        log_config=log_config,
+        loop=loop,
+        http=http,
+        timeout_keep_alive=timeout_keep_alive,
+        backlog=backlog,
+    )
 
 
 if __name__ == "__main__":
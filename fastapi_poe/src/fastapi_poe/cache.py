@@ -0,0 +1,188 @@
+"""
+
+Caching the final responses of API bots.
+
+Bots that are deterministic for a given conversation, such as classifiers and
+rewriters, are often sent the same query again and again. A ResponseCache keeps their
+responses keyed by the bot name and the content of the query, so that repeated
+queries are answered without contacting the bot. Concurrent identical queries are
+sent to the bot only once, and share its response.
+
+"""
+import asyncio
+import functools
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+from .types import QueryRequest
+
+T = TypeVar("T")
+
+
+def request_cache_key(bot_name: str, request: QueryRequest) -> str:
+    """Return a hash of *bot_name* and the content of *request*.
+
+    Fields that differ between otherwise identical queries, i.e. the user,
+    conversation and message IDs and the timestamps, IDs and feedback of the
+    messages, are ignored.
+
+    """
+    content = [
+        bot_name,
+        request.version,
+        [
+            [message.role, message.content_type, message.content]
+            for message in request.query
+        ],
+    ]
+    return hashlib.sha256(json.dumps(content).encode()).hexdigest()
+
+
+class ResponseCache:
+    """Keeps the *max_entries* most recently used responses in memory and, if *path*
+    is given, all responses in a local SQLite database as well.
+
+    Responses older than *ttl* seconds are not used. The database survives restarts
+    and can be shared between processes; it must only be writable by the bot.
+
+    """
+
+    def __init__(
+        self,
+        *,
+        max_entries: int = 1000,
+        ttl: Optional[float] = None,
+        path: Optional[str] = None,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        # Key -> (time.time() when stored, response), least recently used first
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._in_flight: Dict[str, "asyncio.Future[str]"] = {}
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.hit_count = 0
+        self.disk_hit_count = 0
+        self.miss_count = 0
+        self.coalesced_count = 0
+
+    async def get_or_fetch(self, key: str, fetch: Callable[[], Awaitable[str]]) -> str:
+        """Return the response cached for *key*, or fetch and cache it.
+
+        While the response is being fetched, callers with the same key wait for it
+        instead of fetching it again. If fetching fails, they all get the error and
+        nothing is cached. Cancelling a caller does not stop the fetch, since others
+        may be waiting for it.
+
+        """
+        response = self._get_from_memory(key)
+        if response is not None:
+            self.hit_count += 1
+            return response
+        in_flight = self._in_flight.get(key)
+        if in_flight is None:
+            in_flight = asyncio.ensure_future(self._fetch(key, fetch))
+            in_flight.add_done_callback(functools.partial(self._forget, key))
+            self._in_flight[key] = in_flight
+        else:
+            self.coalesced_count += 1
+        return await asyncio.shield(in_flight)
+
+    async def _fetch(self, key: str, fetch: Callable[[], Awaitable[str]]) -> str:
+        response = None
+        if self.path is not None:
+            response = await self._run(lambda: self._get_from_disk(key))
+        if response is not None:
+            self.hit_count += 1
+            self.disk_hit_count += 1
+        else:
+            self.miss_count += 1
+            response = await fetch()
+            if self.path is not None:
+                stored = response
+                await self._run(lambda: self._save_to_disk(key, stored))
+        self._save_to_memory(key, response)
+        return response
+
+    def _forget(self, key: str, in_flight: "asyncio.Future[str]") -> None:
+        if self._in_flight.get(key) is in_flight:
+            del self._in_flight[key]
+        if not in_flight.cancelled():
+            # Nobody may be waiting for the fetch; don't log its error as unretrieved
+            in_flight.exception()
+
+    def clear(self) -> None:
+        """Forget the responses kept in memory."""
+        self._entries.clear()
+
+    def _is_fresh(self, stored_at: float) -> bool:
+        return self.ttl is None or time.time() - stored_at < self.ttl
+
+    def _get_from_memory(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, response = entry
+        if not self._is_fresh(stored_at):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return response
+
+    def _save_to_memory(self, key: str, response: str) -> None:
+        self._entries[key] = (time.time(), response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _get_from_disk(self, key: str) -> Optional[str]:
+        row = (
+            self._get_connection()
+            .execute("SELECT stored_at, response FROM responses WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None or not self._is_fresh(row[0]):
+            return None
+        return row[1]
+
+    def _save_to_disk(self, key: str, response: str) -> None:
+        connection = self._get_connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+            (key, time.time(), response),
+        )
+        if self.ttl is not None:
+            connection.execute(
+                "DELETE FROM responses WHERE stored_at < ?", (time.time() - self.ttl,)
+            )
+
+    async def _run(self, function: Callable[[], T]) -> T:
+        def run() -> T:
+            with self._lock:
+                connection = self._get_connection()
+                with connection:
+                    return function()
+
+        return await asyncio.get_event_loop().run_in_executor(None, run)
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            assert self.path is not None
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses"
+                " (key TEXT PRIMARY KEY, stored_at REAL, response TEXT)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_stored_at"
+                " ON responses (stored_at)"
+            )
+            connection.commit()
+            self._connection = connection
+        return self._connection
@@ -6,12 +6,36 @@ Client for talking to other Poe bots through Poe's bot API.
 import asyncio
 import contextlib
 import json
+import math
+import random
+import time
+from collections import deque
 from dataclasses import dataclass, field
-from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, cast
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+    cast,
+)
 
 import httpx
 import httpx_sse
+from typing_extensions import Literal, TypeAlias
 
+from .admission import _TokenBucket
+from .cache import ResponseCache, request_cache_key
+from .metrics import StreamMetrics
 from .types import ContentType, Identifier, QueryRequest, SettingsResponse
 
 API_VERSION = "1.0"
@@ -20,7 +44,19 @@ MESSAGE_LENGTH_LIMIT = 10_000
 IDENTIFIER_LENGTH = 32
 MAX_EVENT_COUNT = 1000
 
+try:
+    import orjson
+
+    _json_loads: Callable[[Union[bytes, str]], Any] = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 ErrorHandler = Callable[[Exception, str], None]
+FanOutMode: TypeAlias = Literal["merge", "first_finish", "first_token"]
+CircuitState: TypeAlias = Literal["closed", "open", "half_open"]
+StreamEventKind: TypeAlias = Literal["replace_response", "suggested_reply", "meta"]
+
+T = TypeVar("T")
 
 
 class BotError(Exception):
@@ -31,6 +67,10 @@ class BotErrorNoRetry(BotError):
     """Subclass of BotError raised when we're not allowed to retry."""
 
 
+class BotUnavailable(BotError):
+    """Raised without contacting the bot when its circuit breaker is open."""
+
+
 class InvalidBotSettings(Exception):
     """Raised when a bot returns invalid settings."""
 
@@ -59,6 +99,102 @@ class MetaMessage(BotMessage):
     content_type: ContentType = "text/markdown"
 
 
+class StreamEvent:
+    """An event other than a text delta, as yielded by stream_deltas().
+
+    *kind* is "replace_response" or "suggested_reply", with the event's *text*, or
+    "meta", with the decoded *data* of the meta event.
+
+    """
+
+    __slots__ = ("kind", "text", "data")
+
+    def __init__(
+        self, kind: StreamEventKind, text: str = "", data: Optional[Any] = None
+    ) -> None:
+        self.kind = kind
+        self.text = text
+        self.data = data
+
+    def __repr__(self) -> str:
+        return f"StreamEvent({self.kind!r}, {self.text!r}, {self.data!r})"
+
+
+# A text delta, or another kind of event
+Delta: TypeAlias = Union[str, StreamEvent]
+
+
+def _make_delta(kind: str, text: str, data: Any) -> Delta:
+    if kind == "text":
+        return text
+    if kind == "meta":
+        return StreamEvent("meta", data=data)
+    return StreamEvent(cast(StreamEventKind, kind), text)
+
+
+@dataclass
+class BotHealth:
+    """Circuit breaker tracking the recent health of a single bot.
+
+    The circuit starts "closed" and requests flow normally. After
+    *failure_threshold* consecutive failed requests it "opens" and requests fail
+    immediately with BotUnavailable. Once *reset_timeout* seconds have passed, it
+    becomes "half_open" and lets a single probe request through: if the probe
+    succeeds the circuit closes again, otherwise it reopens.
+
+    """
+
+    failure_threshold: int = 5
+    reset_timeout: float = 30.0
+    consecutive_failures: int = 0
+    opened_at: Optional[float] = None
+    probe_in_flight: bool = False
+
+    @property
+    def state(self) -> CircuitState:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def acquire(self) -> bool:
+        """Check whether a request may be sent now.
+
+        Returns True if the request is the half-open probe, in which case its
+        outcome must be recorded or the probe released.
+
+        """
+        state = self.state
+        if state == "closed":
+            return False
+        if state == "open" or self.probe_in_flight:
+            raise BotUnavailable("Circuit breaker is open")
+        self.probe_in_flight = True
+        return True
+
+    def release(self) -> None:
+        """Give up a probe whose outcome is unknown, e.g. because it was cancelled."""
+        self.probe_in_flight = False
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self.probe_in_flight or self.consecutive_failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self.probe_in_flight = False
+
+
+def _get_retry_delay(base: float, maximum: float, exponent: int) -> float:
+    """Exponential backoff with jitter, so that retries from callers are spread out."""
+    delay = min(maximum, base * 2**exponent)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
 def _safe_ellipsis(obj: object, limit: int) -> str:
     if not isinstance(obj, str):
         obj = repr(obj)
@@ -67,17 +203,189 @@ def _safe_ellipsis(obj: object, limit: int) -> str:
     return obj
 
 
+def _decode_text(data: str) -> Optional[str]:
+    """Return the text of a plain {"text": "..."} event, or None to fully decode it.
+
+    The text of data without escapes, control characters or extra keys is the
+    part between the quotes, so most events need no JSON decoding.
+
+    """
+    if data.startswith('{"text": "'):
+        start = 10
+    elif data.startswith('{"text":"'):
+        start = 9
+    else:
+        return None
+    if (
+        data.endswith('"}')
+        and data.count('"') == 4
+        and "\\" not in data
+        and data.isprintable()
+    ):
+        return data[start:-2]
+    return None
+
+
+def _query_request_payload(request: QueryRequest) -> Dict[str, Any]:
+    # The query may be a LazyProtocolMessages, which pydantic cannot serialize
+    payload = request.dict(exclude={"query"})
+    payload["query"] = [message.dict() for message in request.query]
+    return payload
+
+
+@dataclass
+class _StreamState:
+    """Accounting for one response, kept across reconnections that resume it."""
+
+    event_count: int = 0
+    error_reported: bool = False
+    # Running totals so that per-event accounting stays O(1)
+    text_received: bool = False
+    total_length: int = 0
+    # ID of the last event received, if the bot numbers its events
+    last_event_id: Optional[str] = None
+
+
+def _is_numbered_before(event_id: str, other_id: str) -> bool:
+    """Whether *event_id* is numbered before *other_id*."""
+    try:
+        return int(event_id) < int(other_id)
+    except ValueError:
+        return False
+
+
+def _default_error_handler(e: Exception, msg: str) -> None:
+    print("Error in Poe API Bot:", msg, e)
+
+
+@dataclass
+class _Report:
+    endpoint: str
+    headers: Dict[str, str]
+    payload: Dict[str, Any]
+    count: int = 1
+
+
+class ReportQueue:
+    """Sends error and feedback reports to bots in the background.
+
+    submit() only queues a report, so a stream never waits for one to be sent.
+    Reports are sent every *flush_interval* seconds, one endpoint after another
+    for each bot and different bots concurrently. Identical reports queued
+    within one interval are sent once; for error reports the number of
+    occurrences is added to the metadata as "report_count". At most *max_size*
+    distinct reports are queued and further ones are dropped. Call aclose() before
+    closing the session to send what is still queued.
+
+    """
+
+    def __init__(
+        self,
+        session: httpx.AsyncClient,
+        *,
+        max_size: int = 1000,
+        flush_interval: float = 1.0,
+        on_error: Optional[ErrorHandler] = _default_error_handler,
+    ) -> None:
+        self.session = session
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.on_error = on_error
+        self._pending: Dict[Tuple[str, str], _Report] = {}
+        self._task: Optional["asyncio.Future[None]"] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._closed = False
+        self.sent_count = 0
+        self.deduplicated_count = 0
+        self.dropped_count = 0
+        self.failed_count = 0
+
+    def submit(
+        self, endpoint: str, headers: Dict[str, str], payload: Dict[str, Any]
+    ) -> None:
+        """Queue a report to be posted to *endpoint*."""
+        key = (endpoint, json.dumps(payload, sort_keys=True, default=repr))
+        report = self._pending.get(key)
+        if report is not None:
+            report.count += 1
+            self.deduplicated_count += 1
+            return
+        if self._closed or len(self._pending) >= self.max_size:
+            self.dropped_count += 1
+            return
+        self._pending[key] = _Report(endpoint, headers, payload)
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def flush(self) -> None:
+        """Send all queued reports now."""
+        pending = self._pending
+        self._pending = {}
+        by_endpoint: Dict[str, List[_Report]] = {}
+        for report in pending.values():
+            by_endpoint.setdefault(report.endpoint, []).append(report)
+        await asyncio.gather(
+            *(self._send_batch(reports) for reports in by_endpoint.values())
+        )
+
+    async def aclose(self) -> None:
+        """Send the queued reports and stop accepting new ones."""
+        self._closed = True
+        if self._task is not None:
+            assert self._wakeup is not None
+            self._wakeup.set()
+            await self._task
+        await self.flush()
+
+    async def _run(self) -> None:
+        try:
+            while self._pending:
+                assert self._wakeup is not None
+                if not self._closed:
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+                await self.flush()
+        finally:
+            self._task = None
+
+    async def _send_batch(self, reports: List[_Report]) -> None:
+        for report in reports:
+            payload = report.payload
+            if report.count > 1 and payload.get("type") == "report_error":
+                metadata = {**payload["metadata"], "report_count": report.count}
+                payload = {**payload, "metadata": metadata}
+            try:
+                await self.session.post(
+                    report.endpoint, headers=report.headers, json=payload
+                )
+            except Exception as e:
+                self.failed_count += 1
+                if self.on_error is not None:
+                    self.on_error(e, f"Could not send report to {report.endpoint}")
+            else:
+                self.sent_count += 1
+
+
 @dataclass
 class _BotContext:
     endpoint: str
     api_key: str = field(repr=False)
     session: httpx.AsyncClient = field(repr=False)
     on_error: Optional[ErrorHandler] = field(default=None, repr=False)
+    # If set, reports are queued instead of being sent before returning
+    reports: Optional[ReportQueue] = field(default=None, repr=False)
 
     @property
     def headers(self) -> Dict[str, str]:
         return {"Accept": "application/json", "Authorization": f"Bearer {self.api_key}"}
 
+    async def _send_report(self, payload: Dict[str, Any]) -> None:
+        if self.reports is not None:
+            self.reports.submit(self.endpoint, self.headers, payload)
+        else:
+            await self.session.post(self.endpoint, headers=self.headers, json=payload)
+
     async def report_error(
         self, message: str, metadata: Optional[Dict[str, Any]] = None
     ) -> None:
@@ -88,15 +396,13 @@ class _BotContext:
                 f"for endpoint {self.endpoint}"
             )
             self.on_error(BotError(message), long_message)
-        await self.session.post(
-            self.endpoint,
-            headers=self.headers,
-            json={
+        await self._send_report(
+            {
                 "version": API_VERSION,
                 "type": "report_error",
                 "message": message,
                 "metadata": metadata or {},
-            },
+            }
         )
 
     async def report_feedback(
@@ -107,17 +413,15 @@ class _BotContext:
         feedback_type: str,
     ) -> None:
         """Report message feedback to the bot server."""
-        await self.session.post(
-            self.endpoint,
-            headers=self.headers,
-            json={
+        await self._send_report(
+            {
                 "version": API_VERSION,
                 "type": "report_feedback",
                 "message_id": message_id,
                 "user_id": user_id,
                 "conversation_id": conversation_id,
                 "feedback_type": feedback_type,
-            },
+            }
         )
 
     async def fetch_settings(self) -> SettingsResponse:
@@ -129,57 +433,120 @@ class _BotContext:
         )
         return resp.json()
 
-    async def perform_query_request(
-        self, request: QueryRequest
+    def perform_query_request(
+        self, request: QueryRequest, state: Optional[_StreamState] = None
     ) -> AsyncGenerator[BotMessage, None]:
-        chunks: List[str] = []
+        """Sends a query and yields the messages in the response.
+
+        Pass the *state* of an earlier attempt whose connection broke to resume
+        that response after its last received event.
+
+        """
+        # Rendering the prompt is proportional to the size of the context window, so
+        # do it at most once per request and share the result between messages.
+        full_prompt: Optional[str] = None
+
+        def make_message(kind: str, text: str, data: Any) -> BotMessage:
+            nonlocal full_prompt
+            if full_prompt is None:
+                full_prompt = repr(request)
+            if kind == "meta":
+                return MetaMessage(
+                    "",
+                    data,
+                    full_prompt=full_prompt,
+                    linkify=data.get("linkify", False),
+                    suggested_replies=data.get("suggested_replies", False),
+                    content_type=data.get("content_type", "text/markdown"),
+                )
+            return BotMessage(
+                text=text,
+                raw_response={"type": kind, "text": data},
+                full_prompt=full_prompt,
+                is_suggested_reply=(kind == "suggested_reply"),
+                is_replace_response=(kind == "replace_response"),
+            )
+
+        return self._stream_events(request, state, make_message)
+
+    def stream_deltas(
+        self, request: QueryRequest, state: Optional[_StreamState] = None
+    ) -> AsyncGenerator[Delta, None]:
+        """Like perform_query_request(), but yields Deltas."""
+        return self._stream_events(request, state, _make_delta)
+
+    async def _stream_events(
+        self,
+        request: QueryRequest,
+        state: Optional[_StreamState],
+        make_event: Callable[[str, str, Any], T],
+    ) -> AsyncGenerator[T, None]:
+        # make_event(kind, text, data) creates what is yielded for each event. kind
+        # is the event type and data is the decoded data of a meta event, or the
+        # raw data of the others.
         message_id = request.message_id
-        event_count = 0
-        error_reported = False
+        if state is None:
+            state = _StreamState()
+        headers = self.headers
+        resumed_after = state.last_event_id
+        if resumed_after is not None:
+            headers = {**headers, "Last-Event-ID": resumed_after}
         async with httpx_sse.aconnect_sse(
             self.session,
             "POST",
             self.endpoint,
-            headers=self.headers,
-            json=request.dict(),
+            headers=headers,
+            json=_query_request_payload(request),
         ) as event_source:
             async for event in event_source.aiter_sse():
-                event_count += 1
-                if event_count > MAX_EVENT_COUNT:
+                state.event_count += 1
+                # Events without an ID of their own, e.g. pings, repeat the last one
+                if event.id and event.id != state.last_event_id:
+                    if resumed_after is not None:
+                        # The first new ID shows whether the bot resumed the response
+                        if _is_numbered_before(event.id, resumed_after):
+                            # Continuing would repeat text the caller already has
+                            raise BotErrorNoRetry(
+                                "Bot restarted the response instead of resuming it"
+                            )
+                        resumed_after = None
+                    state.last_event_id = event.id
+                if state.event_count > MAX_EVENT_COUNT:
                     await self.report_error(
                         "Bot returned too many events", {"message_id": message_id}
                     )
                     raise BotErrorNoRetry("Bot returned too many events")
                 if event.event == "done":
                     # Don't send a report if we already told the bot about some other mistake.
-                    if not chunks and not error_reported:
+                    if not state.text_received and not state.error_reported:
                         await self.report_error(
                             "Bot returned no text in response",
                             {"message_id": message_id},
                         )
                     return
                 elif event.event == "text":
-                    text = await self._get_single_json_field(
-                        event.data, "text", message_id
-                    )
+                    text = _decode_text(event.data)
+                    if text is None:
+                        text = await self._get_single_json_field(
+                            event.data, "text", message_id
+                        )
                 elif event.event == "replace_response":
-                    text = await self._get_single_json_field(
-                        event.data, "replace_response", message_id
-                    )
-                    chunks.clear()
+                    text = _decode_text(event.data)
+                    if text is None:
+                        text = await self._get_single_json_field(
+                            event.data, "replace_response", message_id
+                        )
+                    state.total_length = 0
                 elif event.event == "suggested_reply":
-                    text = await self._get_single_json_field(
-                        event.data, "suggested_reply", message_id
-                    )
-                    yield BotMessage(
-                        text=text,
-                        raw_response={"type": event.event, "text": event.data},
-                        full_prompt=repr(request),
-                        is_suggested_reply=True,
-                    )
+                    text = _decode_text(event.data)
+                    if text is None:
+                        text = await self._get_single_json_field(
+                            event.data, "suggested_reply", message_id
+                        )
+                    yield make_event("suggested_reply", text, event.data)
                     continue
                 elif event.event == "meta":
-                    if event_count != 1:
+                    if state.event_count != 1:
                         # spec says a meta event that is not the first event is ignored
                         continue
                     data = await self._load_json_dict(event.data, "meta", message_id)
@@ -189,7 +556,7 @@ class _BotContext:
                             "Invalid linkify value in 'meta' event",
                             {"message_id": message_id, "linkify": linkify},
                         )
-                        error_reported = True
+                        state.error_reported = True
                         continue
                     send_suggested_replies = data.get("suggested_replies", False)
                     if not isinstance(send_suggested_replies, bool):
@@ -200,7 +567,7 @@ class _BotContext:
                                 "suggested_replies": send_suggested_replies,
                             },
                         )
-                        error_reported = True
+                        state.error_reported = True
                         continue
                     content_type = data.get("content_type", "text/markdown")
                     if not isinstance(content_type, str):
@@ -208,16 +575,9 @@ class _BotContext:
                             "Invalid content_type value in 'meta' event",
                             {"message_id": message_id, "content_type": content_type},
                         )
-                        error_reported = True
+                        state.error_reported = True
                         continue
-                    yield MetaMessage(
-                        "",
-                        data,
-                        full_prompt=repr(request),
-                        linkify=linkify,
-                        suggested_replies=send_suggested_replies,
-                        content_type=cast(ContentType, content_type),
-                    )
+                    yield make_event("meta", "", data)
                     continue
                 elif event.event == "error":
                     data = await self._load_json_dict(event.data, "error", message_id)
@@ -238,22 +598,20 @@ class _BotContext:
                             "message_id": message_id,
                         },
                     )
-                    error_reported = True
+                    state.error_reported = True
                     continue
-                chunks.append(text)
-                total_length = sum(len(chunk) for chunk in chunks)
-                if total_length > MESSAGE_LENGTH_LIMIT:
+                state.text_received = True
+                state.total_length += len(text)
+                if state.total_length > MESSAGE_LENGTH_LIMIT:
                     await self.report_error(
                         "Bot returned too much text",
-                        {"message_id": message_id, "response_length": total_length},
+                        {
+                            "message_id": message_id,
+                            "response_length": state.total_length,
+                        },
                     )
                     raise BotErrorNoRetry("Bot returned too much text")
-                yield BotMessage(
-                    text=text,
-                    raw_response={"type": event.event, "text": event.data},
-                    full_prompt=repr(request),
-                    is_replace_response=(event.event == "replace_response"),
-                )
+                yield make_event(event.event, text, event.data)
         await self.report_error(
             "Bot exited without sending 'done' event", {"message_id": message_id}
         )
@@ -275,7 +633,7 @@ class _BotContext:
         self, data: str, context: str, message_id: Identifier
     ) -> Dict[str, object]:
         try:
-            parsed = json.loads(data)
+            parsed = _json_loads(data)
         except json.JSONDecodeError:
             await self.report_error(
                 f"Invalid JSON in {context!r} event",
@@ -292,11 +650,49 @@ class _BotContext:
         return cast(Dict[str, object], parsed)
 
 
-def _default_error_handler(e: Exception, msg: str) -> None:
-    print("Error in Poe API Bot:", msg, e)
+def stream_request(
+    request: QueryRequest,
+    bot_name: str,
+    api_key: str,
+    *,
+    session: Optional[httpx.AsyncClient] = None,
+    on_error: ErrorHandler = _default_error_handler,
+    num_tries: int = 2,
+    retry_sleep_time: float = 0.5,
+    max_retry_sleep_time: float = 8.0,
+    base_url: str = "https://api.poe.com/bot/",
+    health: Optional[BotHealth] = None,
+    reports: Optional[ReportQueue] = None,
+) -> AsyncGenerator[BotMessage, None]:
+    """Streams BotMessages from an API bot.
+
+    If the connection breaks and the bot supports resumable streams, the retry
+    continues the response after the last event received instead of failing.
+    Failed attempts are retried after an exponentially growing, jittered delay
+    starting at *retry_sleep_time*. If *health* is given, it is updated with the
+    outcome of the request, the delay also grows with the bot's recent consecutive
+    failures, and BotUnavailable is raised right away if its circuit is open.
+    Protocol errors are reported to the bot through *reports*; without one, they
+    are sent in the background and the remaining ones when the stream ends.
 
+    """
+    return _stream_with_retries(
+        _BotContext.perform_query_request,
+        request,
+        bot_name,
+        api_key,
+        session=session,
+        on_error=on_error,
+        num_tries=num_tries,
+        retry_sleep_time=retry_sleep_time,
+        max_retry_sleep_time=max_retry_sleep_time,
+        base_url=base_url,
+        health=health,
+        reports=reports,
+    )
 
-async def stream_request(
+
+def stream_deltas(
     request: QueryRequest,
     bot_name: str,
     api_key: str,
@@ -305,36 +701,120 @@ async def stream_request(
     on_error: ErrorHandler = _default_error_handler,
     num_tries: int = 2,
     retry_sleep_time: float = 0.5,
+    max_retry_sleep_time: float = 8.0,
     base_url: str = "https://api.poe.com/bot/",
-) -> AsyncGenerator[BotMessage, None]:
-    """Streams BotMessages from an API bot."""
+    health: Optional[BotHealth] = None,
+    reports: Optional[ReportQueue] = None,
+) -> AsyncGenerator[Delta, None]:
+    """Streams the response of an API bot as Deltas.
+
+    Each text event is yielded as a plain string, and other events as a
+    StreamEvent. The response is checked, retried and reported on exactly as in
+    stream_request(), but without creating a BotMessage per event.
+
+    """
+    return _stream_with_retries(
+        _BotContext.stream_deltas,
+        request,
+        bot_name,
+        api_key,
+        session=session,
+        on_error=on_error,
+        num_tries=num_tries,
+        retry_sleep_time=retry_sleep_time,
+        max_retry_sleep_time=max_retry_sleep_time,
+        base_url=base_url,
+        health=health,
+        reports=reports,
+    )
+
+
+async def _stream_with_retries(
+    perform: Callable[
+        [_BotContext, QueryRequest, _StreamState], AsyncGenerator[T, None]
+    ],
+    request: QueryRequest,
+    bot_name: str,
+    api_key: str,
+    *,
+    session: Optional[httpx.AsyncClient],
+    on_error: ErrorHandler,
+    num_tries: int,
+    retry_sleep_time: float,
+    max_retry_sleep_time: float,
+    base_url: str,
+    health: Optional[BotHealth],
+    reports: Optional[ReportQueue],
+) -> AsyncGenerator[T, None]:
     async with contextlib.AsyncExitStack() as stack:
         if session is None:
             session = await stack.enter_async_context(httpx.AsyncClient())
+        if reports is None:
+            reports = ReportQueue(session, on_error=on_error)
+            stack.push_async_callback(reports.aclose)
         url = f"{base_url}{bot_name}"
         ctx = _BotContext(
-            endpoint=url, api_key=api_key, session=session, on_error=on_error
+            endpoint=url,
+            api_key=api_key,
+            session=session,
+            on_error=on_error,
+            reports=reports,
         )
         got_response = False
-        for i in range(num_tries):
-            try:
-                async for message in ctx.perform_query_request(request):
-                    got_response = True
-                    yield message
-                break
-            except BotErrorNoRetry:
-                raise
-            except Exception as e:
-                on_error(e, f"Bot request to {bot_name} failed on try {i}")
-                if got_response or i == num_tries - 1:
-                    raise BotError(f"Error communicating with bot {bot_name}") from e
-                await asyncio.sleep(retry_sleep_time)
+        state = _StreamState()
+        # The circuit breaker counts requests, so the retries of a request share
+        # a single outcome.
+        is_probe = health.acquire() if health is not None else False
+        outcome_recorded = False
+        try:
+            for i in range(num_tries):
+                try:
+                    async for event in perform(ctx, request, state):
+                        got_response = True
+                        yield event
+                    break
+                except Exception as e:
+                    if isinstance(e, BotErrorNoRetry):
+                        raise
+                    on_error(e, f"Bot request to {bot_name} failed on try {i}")
+                    # If the bot numbers its events and the connection broke, the next
+                    # try resumes the response after the last event we received.
+                    can_resume = (
+                        isinstance(e, httpx.TransportError)
+                        and state.last_event_id is not None
+                    )
+                    if (got_response and not can_resume) or i == num_tries - 1:
+                        raise BotError(
+                            f"Error communicating with bot {bot_name}"
+                        ) from e
+                    if not can_resume:
+                        state = _StreamState()
+                    exponent = i
+                    if health is not None:
+                        exponent = max(i, health.consecutive_failures)
+                    await asyncio.sleep(
+                        _get_retry_delay(
+                            retry_sleep_time, max_retry_sleep_time, exponent
+                        )
+                    )
+            if health is not None:
+                health.record_success()
+                outcome_recorded = True
+        except Exception:
+            if health is not None:
+                health.record_failure()
+                outcome_recorded = True
+            raise
+        finally:
+            if health is not None and is_probe and not outcome_recorded:
+                health.release()
 
 
-async def get_final_response(request: QueryRequest, bot_name: str, api_key: str) -> str:
-    """Gets the final response from an API bot."""
+async def _collect_final_response(
+    messages: AsyncIterator[BotMessage], bot_name: str
+) -> str:
     chunks: List[str] = []
-    async for message in stream_request(request, bot_name, api_key):
+    async for message in messages:
         if isinstance(message, MetaMessage):
             continue
         if message.is_suggested_reply:
@@ -345,3 +825,763 @@ async def get_final_response(request: QueryRequest, bot_name: str, api_key: str)
     if not chunks:
         raise BotError(f"Bot {bot_name} sent no response")
     return "".join(chunks)
+
+
+async def get_final_response(
+    request: QueryRequest,
+    bot_name: str,
+    api_key: str,
+    *,
+    session: Optional[httpx.AsyncClient] = None,
+) -> str:
+    """Gets the final response from an API bot."""
+    return await _collect_final_response(
+        stream_request(request, bot_name, api_key, session=session), bot_name
+    )
+
+
+def _is_response_text(message: BotMessage) -> bool:
+    return not isinstance(message, MetaMessage) and not message.is_suggested_reply
+
+
+def _get_response_text(message: BotMessage) -> Optional[str]:
+    return message.text if _is_response_text(message) else None
+
+
+def _get_delta_text(delta: Delta) -> Optional[str]:
+    if isinstance(delta, str):
+        return delta
+    return delta.text if delta.kind == "replace_response" else None
+
+
+def _percentile(samples: Sequence[float], percentile: float) -> float:
+    ordered = sorted(samples)
+    index = max(0, math.ceil(percentile * len(ordered)) - 1)
+    return ordered[index]
+
+
+class _StreamEnd:
+    """Queue marker for a fan-out stream that finished successfully."""
+
+
+class PoeClient:
+    """Long-lived client for talking to API bots over a shared connection pool.
+
+    Creating an httpx.AsyncClient per call means every request pays for a new TCP
+    and TLS handshake. A PoeClient owns a single pooled client that is reused by
+    all of its methods. Create one when your server starts and close it on
+    shutdown, either with ``async with PoeClient(...)`` or by calling start() and
+    aclose() explicitly.
+
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        *,
+        base_url: str = "https://api.poe.com/bot/",
+        max_connections: Optional[int] = 100,
+        max_keepalive_connections: Optional[int] = 20,
+        keepalive_expiry: Optional[float] = 30.0,
+        max_connections_per_host: Optional[int] = None,
+        http2: bool = False,
+        timeout: Union[float, httpx.Timeout] = 5.0,
+        circuit_failure_threshold: int = 5,
+        circuit_reset_timeout: float = 30.0,
+        collect_metrics: bool = False,
+        report_flush_interval: float = 1.0,
+        max_queued_reports: int = 1000,
+        response_cache: Optional[ResponseCache] = None,
+    ) -> None:
+        """
+        :param api_key: The Poe API key to send with each request.
+        :param base_url: URL that bot names are appended to.
+        :param max_connections: Maximum number of connections in the pool.
+        :param max_keepalive_connections: Maximum number of idle connections that
+        are kept open for reuse.
+        :param keepalive_expiry: Seconds after which an idle connection is closed.
+        :param max_connections_per_host: If set, at most this many requests run
+        concurrently against a single host; the rest wait for a free slot.
+        :param http2: Whether to enable HTTP/2. Requires the ``h2`` package.
+        :param timeout: Timeout passed to httpx.
+        :param circuit_failure_threshold: Number of consecutive failed requests
+        after which requests to a bot fail fast with BotUnavailable.
+        :param circuit_reset_timeout: Seconds after which a single probe request is
+        let through to a bot whose circuit is open.
+        :param collect_metrics: Whether to record latency histograms and counts for
+        the responses of each bot, see get_metrics().
+        :param report_flush_interval: Seconds between sends of the error and
+        feedback reports queued for bots, see get_report_queue().
+        :param max_queued_reports: Maximum number of distinct reports waiting to be
+        sent; further ones are dropped.
+        :param response_cache: If set, get_final_response() returns cached responses
+        for queries it has seen before. Only use it for bots whose response depends
+        on nothing but the conversation.
+
+        """
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_connections_per_host = max_connections_per_host
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._http2 = http2
+        self._timeout = timeout
+        self._session: Optional[httpx.AsyncClient] = None
+        self._closed = False
+        self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+        # Recent time-to-first-text samples per bot, used to pick hedging delays
+        self._first_text_latencies: Dict[str, Deque[float]] = {}
+        self.circuit_failure_threshold = circuit_failure_threshold
+        self.circuit_reset_timeout = circuit_reset_timeout
+        self._health: Dict[str, BotHealth] = {}
+        self.collect_metrics = collect_metrics
+        self._metrics: Dict[str, StreamMetrics] = {}
+        self.report_flush_interval = report_flush_interval
+        self.max_queued_reports = max_queued_reports
+        self._reports: Optional[ReportQueue] = None
+        self.response_cache = response_cache
+
+    @property
+    def session(self) -> httpx.AsyncClient:
+        """The underlying pooled httpx client, created on first use."""
+        return self._get_session()
+
+    def _get_session(self) -> httpx.AsyncClient:
+        if self._closed:
+            raise RuntimeError("PoeClient has been closed")
+        if self._session is None:
+            self._session = httpx.AsyncClient(
+                limits=self._limits, http2=self._http2, timeout=self._timeout
+            )
+        return self._session
+
+    async def start(self) -> None:
+        """Create the connection pool, e.g. from a server startup hook."""
+        self._get_session()
+
+    async def aclose(self) -> None:
+        """Close all pooled connections, e.g. from a server shutdown hook.
+
+        Reports that are still queued are sent first.
+
+        """
+        if self._reports is not None:
+            await self._reports.aclose()
+            self._reports = None
+        self._closed = True
+        if self._session is not None:
+            await self._session.aclose()
+            self._session = None
+
+    async def __aenter__(self) -> "PoeClient":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        await self.aclose()
+
+    def _get_context(
+        self, bot_name: str, on_error: Optional[ErrorHandler] = None
+    ) -> _BotContext:
+        return _BotContext(
+            endpoint=f"{self.base_url}{bot_name}",
+            api_key=self.api_key,
+            session=self.session,
+            on_error=on_error,
+            reports=self.get_report_queue(),
+        )
+
+    def get_report_queue(self) -> ReportQueue:
+        """Return the queue through which error and feedback reports are sent."""
+        if self._reports is None:
+            self._reports = ReportQueue(
+                self.session,
+                max_size=self.max_queued_reports,
+                flush_interval=self.report_flush_interval,
+            )
+        return self._reports
+
+    def get_bot_health(self, bot_name: str) -> BotHealth:
+        """Return the circuit breaker shared by all requests to this bot."""
+        health = self._health.get(bot_name)
+        if health is None:
+            health = BotHealth(
+                failure_threshold=self.circuit_failure_threshold,
+                reset_timeout=self.circuit_reset_timeout,
+            )
+            self._health[bot_name] = health
+        return health
+
+    def is_available(self, bot_name: str) -> bool:
+        """Whether a request to the bot would be sent rather than fail fast."""
+        health = self.get_bot_health(bot_name)
+        return health.state == "closed" or (
+            health.state == "half_open" and not health.probe_in_flight
+        )
+
+    @contextlib.asynccontextmanager
+    async def _host_slot(self, bot_name: str) -> AsyncIterator[None]:
+        if self.max_connections_per_host is None:
+            yield
+            return
+        host = httpx.URL(f"{self.base_url}{bot_name}").host
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_connections_per_host)
+            self._host_semaphores[host] = semaphore
+        async with semaphore:
+            yield
+
+    def stream_request(
+        self,
+        request: QueryRequest,
+        bot_name: str,
+        *,
+        on_error: ErrorHandler = _default_error_handler,
+        num_tries: int = 2,
+        retry_sleep_time: float = 0.5,
+        max_retry_sleep_time: float = 8.0,
+    ) -> AsyncGenerator[BotMessage, None]:
+        """Streams BotMessages from an API bot.
+
+        Raises BotUnavailable without sending a request if the bot's circuit
+        breaker is open.
+
+        """
+        return self._stream(
+            _BotContext.perform_query_request,
+            _get_response_text,
+            request,
+            bot_name,
+            on_error=on_error,
+            num_tries=num_tries,
+            retry_sleep_time=retry_sleep_time,
+            max_retry_sleep_time=max_retry_sleep_time,
+        )
+
+    def stream_deltas(
+        self,
+        request: QueryRequest,
+        bot_name: str,
+        *,
+        on_error: ErrorHandler = _default_error_handler,
+        num_tries: int = 2,
+        retry_sleep_time: float = 0.5,
+        max_retry_sleep_time: float = 8.0,
+    ) -> AsyncGenerator[Delta, None]:
+        """Streams the response of an API bot as Deltas, see stream_deltas()."""
+        return self._stream(
+            _BotContext.stream_deltas,
+            _get_delta_text,
+            request,
+            bot_name,
+            on_error=on_error,
+            num_tries=num_tries,
+            retry_sleep_time=retry_sleep_time,
+            max_retry_sleep_time=max_retry_sleep_time,
+        )
+
+    async def _stream(
+        self,
+        perform: Callable[
+            [_BotContext, QueryRequest, _StreamState], AsyncGenerator[T, None]
+        ],
+        get_text: Callable[[T], Optional[str]],
+        request: QueryRequest,
+        bot_name: str,
+        *,
+        on_error: ErrorHandler,
+        num_tries: int,
+        retry_sleep_time: float,
+        max_retry_sleep_time: float,
+    ) -> AsyncGenerator[T, None]:
+        async with self._host_slot(bot_name):
+            start = time.monotonic()
+            got_text = False
+            recorder = None
+            if self.collect_metrics:
+                recorder = self.get_metrics(bot_name).start(start)
+            try:
+                async for event in _stream_with_retries(
+                    perform,
+                    request,
+                    bot_name,
+                    self.api_key,
+                    session=self.session,
+                    on_error=on_error,
+                    num_tries=num_tries,
+                    retry_sleep_time=retry_sleep_time,
+                    max_retry_sleep_time=max_retry_sleep_time,
+                    base_url=self.base_url,
+                    health=self.get_bot_health(bot_name),
+                    reports=self.get_report_queue(),
+                ):
+                    text = get_text(event)
+                    if not got_text and text is not None:
+                        got_text = True
+                        self._record_first_text_latency(
+                            bot_name, time.monotonic() - start
+                        )
+                    if recorder is not None:
+                        recorder.record_event(len(text) if text is not None else 0)
+                    yield event
+            except Exception as e:
+                if recorder is not None:
+                    recorder.record_error(type(e).__name__)
+                raise
+            finally:
+                if recorder is not None:
+                    recorder.finish()
+
+    def get_metrics(self, bot_name: str) -> StreamMetrics:
+        """Return the metrics recorded for responses from this bot."""
+        metrics = self._metrics.get(bot_name)
+        if metrics is None:
+            metrics = StreamMetrics(side="client", bot=bot_name)
+            self._metrics[bot_name] = metrics
+        return metrics
+
+    def _record_first_text_latency(self, bot_name: str, latency: float) -> None:
+        samples = self._first_text_latencies.get(bot_name)
+        if samples is None:
+            samples = deque(maxlen=100)
+            self._first_text_latencies[bot_name] = samples
+        samples.append(latency)
+
+    def get_first_text_latency(
+        self, bot_name: str, percentile: float = 0.95
+    ) -> Optional[float]:
+        """Return a percentile of the bot's recent time-to-first-text latency.
+
+        Returns None if no requests to the bot have produced text yet.
+
+        """
+        samples = self._first_text_latencies.get(bot_name)
+        if not samples:
+            return None
+        return _percentile(samples, percentile)
+
+    async def stream_fan_out(
+        self,
+        request: QueryRequest,
+        bot_names: Sequence[str],
+        *,
+        mode: FanOutMode = "merge",
+        max_concurrency: Optional[int] = None,
+        on_error: ErrorHandler = _default_error_handler,
+    ) -> AsyncGenerator[Tuple[str, BotMessage], None]:
+        """Sends the same query to several bots concurrently.
+
+        Yields (bot_name, message) pairs. The *mode* decides which messages are
+        passed on:
+
+        - "merge": messages from all bots, interleaved as they arrive.
+        - "first_finish": the complete response of the first bot that finishes;
+          the other requests are cancelled.
+        - "first_token": the response of the first bot that sends text; the other
+          requests are cancelled as soon as it does.
+
+        Bots that fail are reported to *on_error* and ignored, unless all of them
+        fail, in which case BotError is raised. At most *max_concurrency* requests
+        are in flight at once.
+
+        """
+        async for item in self._race(
+            request,
+            bot_names,
+            mode=mode,
+            max_concurrency=max_concurrency,
+            hedge_delay=None,
+            on_error=on_error,
+        ):
+            yield item
+
+    async def stream_hedged(
+        self,
+        request: QueryRequest,
+        bot_names: Sequence[str],
+        *,
+        hedge_delay: Optional[float] = None,
+        hedge_percentile: float = 0.95,
+        default_hedge_delay: float = 1.0,
+        on_error: ErrorHandler = _default_error_handler,
+    ) -> AsyncGenerator[Tuple[str, BotMessage], None]:
+        """Sends a query to the first bot, hedging with backups if it is slow.
+
+        If a bot has not sent any text after the hedging delay, or fails, the query
+        is also sent to the next bot in *bot_names*. The first bot to send text wins
+        and all other requests are cancelled. Yields (bot_name, message) pairs from
+        the winner.
+
+        The hedging delay is *hedge_delay* if given. Otherwise it is the
+        *hedge_percentile* of the previous bot's recent time-to-first-text, or
+        *default_hedge_delay* if there are no samples for it yet.
+
+        """
+
+        def get_delay(bot_name: str) -> float:
+            if hedge_delay is not None:
+                return hedge_delay
+            latency = self.get_first_text_latency(bot_name, hedge_percentile)
+            return default_hedge_delay if latency is None else latency
+
+        async for item in self._race(
+            request,
+            bot_names,
+            mode="first_token",
+            max_concurrency=None,
+            hedge_delay=get_delay,
+            on_error=on_error,
+        ):
+            yield item
+
+    async def _race(
+        self,
+        request: QueryRequest,
+        bot_names: Sequence[str],
+        *,
+        mode: FanOutMode,
+        max_concurrency: Optional[int],
+        hedge_delay: Optional[Callable[[str], float]],
+        on_error: ErrorHandler,
+    ) -> AsyncGenerator[Tuple[str, BotMessage], None]:
+        if not bot_names:
+            raise ValueError("At least one bot name is required")
+        # Items are keyed by position so the same bot may be listed more than once.
+        queue: "asyncio.Queue[Tuple[int, object]]" = asyncio.Queue()
+        semaphore = (
+            asyncio.Semaphore(max_concurrency) if max_concurrency is not None else None
+        )
+
+        async def run_one(index: int) -> None:
+            try:
+                async with contextlib.AsyncExitStack() as stack:
+                    if semaphore is not None:
+                        await stack.enter_async_context(semaphore)
+                    async for message in self.stream_request(
+                        request, bot_names[index], on_error=on_error
+                    ):
+                        queue.put_nowait((index, message))
+                queue.put_nowait((index, _StreamEnd()))
+            except Exception as e:
+                queue.put_nowait((index, e))
+
+        tasks: List["asyncio.Task[None]"] = []
+        running: Set[int] = set()
+        buffers: Dict[int, List[BotMessage]] = {}
+        winner: Optional[int] = None
+        last_error: Optional[Exception] = None
+        failure_count = 0
+        hedge_deadline = 0.0
+
+        def launch() -> None:
+            nonlocal hedge_deadline
+            index = len(tasks)
+            running.add(index)
+            buffers[index] = []
+            tasks.append(asyncio.ensure_future(run_one(index)))
+            if hedge_delay is not None:
+                hedge_deadline = time.monotonic() + hedge_delay(bot_names[index])
+
+        def set_winner(index: int) -> None:
+            nonlocal winner
+            winner = index
+            for i, task in enumerate(tasks):
+                if i != index:
+                    task.cancel()
+
+        try:
+            if hedge_delay is None:
+                while len(tasks) < len(bot_names):
+                    launch()
+            else:
+                launch()
+            while running or len(tasks) < len(bot_names):
+                hedging = (
+                    hedge_delay is not None
+                    and winner is None
+                    and len(tasks) < len(bot_names)
+                )
+                if hedging and not running:
+                    # Everything in flight failed; move on to the next bot right away.
+                    launch()
+                    continue
+                try:
+                    if hedging:
+                        timeout = max(0.0, hedge_deadline - time.monotonic())
+                        index, item = await asyncio.wait_for(queue.get(), timeout)
+                    else:
+                        index, item = await queue.get()
+                except asyncio.TimeoutError:
+                    launch()
+                    continue
+                if winner is not None and index != winner:
+                    continue
+                bot_name = bot_names[index]
+                if isinstance(item, Exception):
+                    running.discard(index)
+                    if index == winner:
+                        raise item
+                    on_error(item, f"Bot request to {bot_name} failed during fan-out")
+                    last_error = item
+                    failure_count += 1
+                    continue
+                if isinstance(item, _StreamEnd):
+                    running.discard(index)
+                    if mode == "merge":
+                        continue
+                    if winner is None:
+                        set_winner(index)
+                        for message in buffers[index]:
+                            yield bot_name, message
+                    return
+                message = cast(BotMessage, item)
+                if mode == "merge" or index == winner:
+                    yield bot_name, message
+                    continue
+                buffers[index].append(message)
+                if mode == "first_token" and _is_response_text(message):
+                    set_winner(index)
+                    for buffered in buffers[index]:
+                        yield bot_name, buffered
+                    buffers.clear()
+            if mode != "merge" or failure_count == len(bot_names):
+                raise BotError(
+                    f"All bots failed: {', '.join(bot_names)}"
+                ) from last_error
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def get_final_response(self, request: QueryRequest, bot_name: str) -> str:
+        """Gets the final response from an API bot.
+
+        If the client has a response_cache, the response to an identical earlier
+        query (see request_cache_key()) is returned from it.
+
+        """
+
+        async def fetch() -> str:
+            return await _collect_final_response(
+                self.stream_request(request, bot_name), bot_name
+            )
+
+        if self.response_cache is None:
+            return await fetch()
+        key = request_cache_key(bot_name, request)
+        return await self.response_cache.get_or_fetch(key, fetch)
+
+    def batch(
+        self,
+        queries: Iterable[Tuple[str, QueryRequest]],
+        *,
+        max_concurrency: int = 16,
+        rate_limits: Optional[Dict[str, float]] = None,
+        ordered: bool = False,
+    ) -> "QueryBatch":
+        """Sends many (bot_name, request) queries, see QueryBatch.
+
+        Usage::
+
+            batch = client.batch(queries, max_concurrency=32, rate_limits={"bot": 5})
+            async for result in batch:
+                ...
+            print(batch.get_stats()["queries_per_second"])
+
+        """
+        return QueryBatch(
+            self,
+            queries,
+            max_concurrency=max_concurrency,
+            rate_limits=rate_limits,
+            ordered=ordered,
+        )
+
+    async def fetch_settings(self, bot_name: str) -> SettingsResponse:
+        """Fetches settings from an API bot."""
+        async with self._host_slot(bot_name):
+            return await self._get_context(bot_name).fetch_settings()
+
+    async def report_feedback(
+        self,
+        bot_name: str,
+        message_id: Identifier,
+        user_id: Identifier,
+        conversation_id: Identifier,
+        feedback_type: str,
+    ) -> None:
+        """Queues message feedback to be reported to an API bot."""
+        await self._get_context(bot_name).report_feedback(
+            message_id, user_id, conversation_id, feedback_type
+        )
+
+
+@dataclass
+class BatchResult:
+    """The outcome of one query of a batch: its final response or the error it
+    failed with."""
+
+    index: int  # position of the query in the batch
+    bot_name: str
+    request: QueryRequest
+    response: Optional[str] = None
+    error: Optional[Exception] = None
+    duration: float = 0.0
+
+
+class QueryBatch:
+    """Runs many queries through a PoeClient and yields their BatchResults.
+
+    Iterating over the batch sends the *queries* with get_final_response(), so they
+    share the client's connection pool, retries, circuit breakers and response
+    cache. At most *max_concurrency* queries are in flight at once, and a bot listed
+    in *rate_limits* is sent at most that many queries per second. A query that is
+    waiting for its bot's rate limit holds its slot.
+
+    Results are yielded as the queries finish, or in the order of *queries* if
+    *ordered* is set; a query then starts only once it is fewer than
+    *max_concurrency* places after the next result to yield. A failed query does
+    not stop the batch; its result has the error instead of a response. The
+    queries are read lazily, so they can come from a generator.
+
+    """
+
+    def __init__(
+        self,
+        client: PoeClient,
+        queries: Iterable[Tuple[str, QueryRequest]],
+        *,
+        max_concurrency: int = 16,
+        rate_limits: Optional[Dict[str, float]] = None,
+        ordered: bool = False,
+    ) -> None:
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self.rate_limits = rate_limits or {}
+        self.ordered = ordered
+        self._queries = queries
+        self._buckets: Dict[str, _TokenBucket] = {}
+        self._started = False
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.submitted_count = 0
+        self.succeeded_count = 0
+        self.failed_count = 0
+        self.in_flight_count = 0
+
+    def get_stats(self) -> Dict[str, float]:
+        finished = self.succeeded_count + self.failed_count
+        elapsed = 0.0
+        if self.started_at is not None:
+            elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        return {
+            "submitted": self.submitted_count,
+            "succeeded": self.succeeded_count,
+            "failed": self.failed_count,
+            "in_flight": self.in_flight_count,
+            "elapsed_seconds": elapsed,
+            "queries_per_second": finished / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def __aiter__(self) -> AsyncIterator[BatchResult]:
+        if self._started:
+            raise RuntimeError("A QueryBatch can only be iterated over once")
+        self._started = True
+        return self._run()
+
+    async def _run(self) -> AsyncGenerator[BatchResult, None]:
+        self.started_at = time.monotonic()
+        queries = enumerate(self._queries)
+        # Bounded, so that workers wait while the consumer falls behind
+        results: "asyncio.Queue[Optional[BatchResult]]" = asyncio.Queue(
+            self.max_concurrency
+        )
+        error: Optional[BaseException] = None
+        # In ordered mode, a query is only started once it is within
+        # max_concurrency of the next result to yield, which bounds how many
+        # results wait for an earlier one.
+        next_index = 0
+        delivered = asyncio.Condition()
+
+        async def work() -> None:
+            # The workers share the iterator, each taking the next query when done
+            for index, (bot_name, request) in queries:
+                if self.ordered:
+                    async with delivered:
+                        while index >= next_index + self.max_concurrency:
+                            await delivered.wait()
+                self.submitted_count += 1
+                self.in_flight_count += 1
+                try:
+                    await self._wait_for_rate_limit(bot_name)
+                    result = await self._query(index, bot_name, request)
+                finally:
+                    self.in_flight_count -= 1
+                await results.put(result)
+
+        async def run_workers() -> None:
+            nonlocal error
+            try:
+                await asyncio.gather(*workers)
+            except Exception as e:
+                # Raised by the iterable of queries
+                error = e
+            await results.put(None)
+
+        workers = [asyncio.ensure_future(work()) for _ in range(self.max_concurrency)]
+        runner = asyncio.ensure_future(run_workers())
+        pending: Dict[int, BatchResult] = {}
+        try:
+            while True:
+                result = await results.get()
+                if result is None:
+                    break
+                if not self.ordered:
+                    yield result
+                    continue
+                pending[result.index] = result
+                while next_index in pending:
+                    yield pending.pop(next_index)
+                    next_index += 1
+                    async with delivered:
+                        delivered.notify_all()
+            if error is not None:
+                raise error
+        finally:
+            self.finished_at = time.monotonic()
+            for task in (runner, *workers):
+                task.cancel()
+            await asyncio.gather(runner, *workers, return_exceptions=True)
+
+    async def _query(
+        self, index: int, bot_name: str, request: QueryRequest
+    ) -> BatchResult:
+        start = time.monotonic()
+        result = BatchResult(index, bot_name, request)
+        try:
+            result.response = await self.client.get_final_response(request, bot_name)
+        except Exception as e:
+            result.error = e
+            self.failed_count += 1
+        else:
+            self.succeeded_count += 1
+        result.duration = time.monotonic() - start
+        return result
+
+    async def _wait_for_rate_limit(self, bot_name: str) -> None:
+        rate = self.rate_limits.get(bot_name)
+        if rate is None:
+            return
+        bucket = self._buckets.get(bot_name)
+        if bucket is None:
+            bucket = _TokenBucket(tokens=1.0, updated_at=time.monotonic())
+            self._buckets[bot_name] = bucket
+        while True:
+            delay = bucket.take(rate, 1.0, time.monotonic())
+            if delay == 0:
+                return
+            await asyncio.sleep(delay)
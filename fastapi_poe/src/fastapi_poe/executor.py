@@ -0,0 +1,141 @@
+"""
+
+Running synchronous bot code without blocking the event loop.
+
+A blocking call made directly from get_response() stalls every other response being
+served by the process. BotExecutor runs such calls, and synchronous generators, on a
+bounded thread pool and hands their results back to the event loop.
+
+"""
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, AsyncGenerator, Callable, Deque, Dict, Iterable, Tuple, TypeVar
+
+T = TypeVar("T")
+
+# Kinds of entries passed from a generator's thread to the event loop
+_ITEM = 0
+_ERROR = 1
+_END = 2
+
+
+class BotExecutor:
+    """A thread pool of at most *max_workers* threads, with usage statistics.
+
+    Work submitted while all threads are busy waits for one to become free; the
+    statistics show how often and for how long that happens.
+
+    """
+
+    def __init__(self, max_workers: int = 8) -> None:
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix="poe-bot")
+        self._lock = threading.Lock()
+        self.busy = 0
+        self.queued = 0
+        self.completed_count = 0
+        self.total_wait_time = 0.0
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "busy": self.busy,
+                "queued": self.queued,
+                "completed": self.completed_count,
+                "total_wait_seconds": self.total_wait_time,
+            }
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Call *func* on the pool and return its result."""
+        call = functools.partial(func, *args, **kwargs)
+        return await asyncio.wrap_future(self._submit(call))
+
+    async def iterate(
+        self, iterable: Iterable[T], *, buffer_size: int = 16
+    ) -> AsyncGenerator[T, None]:
+        """Iterate over *iterable* on the pool, yielding its items.
+
+        The thread runs ahead of the consumer by at most *buffer_size* items and
+        then waits, so a slow client also slows down the generator. If iteration
+        stops early, the generator is closed in its thread.
+
+        """
+        loop = asyncio.get_event_loop()
+        entries: Deque[Tuple[int, Any]] = deque()
+        ready = asyncio.Event()
+        # One slot per item the thread may produce before the consumer catches up
+        slots = threading.Semaphore(buffer_size)
+        stopped = False
+
+        def deliver(entry: Tuple[int, Any]) -> None:
+            entries.append(entry)
+            ready.set()
+
+        def produce() -> None:
+            iterator = iter(iterable)
+            try:
+                while True:
+                    slots.acquire()
+                    if stopped:
+                        return
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        loop.call_soon_threadsafe(deliver, (_END, None))
+                        return
+                    loop.call_soon_threadsafe(deliver, (_ITEM, item))
+            except BaseException as e:
+                loop.call_soon_threadsafe(deliver, (_ERROR, e))
+                raise
+            finally:
+                close = getattr(iterator, "close", None)
+                if close is not None:
+                    close()
+
+        self._submit(produce)
+        try:
+            while True:
+                if not entries:
+                    ready.clear()
+                    await ready.wait()
+                kind, value = entries.popleft()
+                if kind == _END:
+                    return
+                if kind == _ERROR:
+                    raise value
+                slots.release()
+                yield value
+        finally:
+            stopped = True
+            # Wake the thread if it is waiting for a slot
+            slots.release()
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False)
+
+    def _submit(self, call: Callable[[], T]) -> "Future[T]":
+        context = contextvars.copy_context()
+        submitted_at = time.monotonic()
+        with self._lock:
+            self.queued += 1
+
+        def run() -> T:
+            with self._lock:
+                self.queued -= 1
+                self.busy += 1
+                self.total_wait_time += time.monotonic() - submitted_at
+            try:
+                # Lets the code use PoeBot.get_deadline() and friends
+                return context.run(call)
+            finally:
+                with self._lock:
+                    self.busy -= 1
+                    self.completed_count += 1
+
+        return self._pool.submit(run)
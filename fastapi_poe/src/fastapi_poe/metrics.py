@@ -0,0 +1,199 @@
+"""
+
+Streaming latency metrics, exposed in the Prometheus text format.
+
+Histograms have fixed buckets and are updated in place, so recording an event does
+not allocate. Every StreamMetrics is registered when it is created, and
+render_metrics() renders all of them.
+
+"""
+import time
+import weakref
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+)
+EVENT_COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+CHARACTER_BUCKETS = (10, 100, 1000, 2500, 5000, 10_000, 25_000, 100_000)
+
+
+class Histogram:
+    """Counts observations into cumulative buckets with the given upper bounds."""
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = tuple(buckets)
+        # One count per bucket, plus one for observations above the last bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class StreamRecorder:
+    """Records the events of a single response into a StreamMetrics."""
+
+    __slots__ = ("metrics", "started_at", "last_event_at", "event_count", "chars")
+
+    def __init__(self, metrics: "StreamMetrics", started_at: float) -> None:
+        self.metrics = metrics
+        self.started_at = started_at
+        self.last_event_at: Optional[float] = None
+        self.event_count = 0
+        self.chars = 0
+        metrics.in_flight += 1
+
+    def record_event(self, chars: int = 0) -> None:
+        now = time.monotonic()
+        if self.last_event_at is None:
+            self.metrics.time_to_first_event.observe(now - self.started_at)
+        else:
+            self.metrics.event_gap.observe(now - self.last_event_at)
+        self.last_event_at = now
+        self.event_count += 1
+        self.chars += chars
+
+    def record_error(self, error_type: str) -> None:
+        errors = self.metrics.errors
+        errors[error_type] = errors.get(error_type, 0) + 1
+
+    def finish(self) -> None:
+        metrics = self.metrics
+        metrics.in_flight -= 1
+        metrics.response_count += 1
+        metrics.duration.observe(time.monotonic() - self.started_at)
+        metrics.events.observe(self.event_count)
+        metrics.response_chars.observe(self.chars)
+
+
+_registry: "weakref.WeakSet[StreamMetrics]" = weakref.WeakSet()
+
+
+class StreamMetrics:
+    """Latency and size statistics for streamed responses.
+
+    *labels* are attached to all of its samples, and tell apart the metrics of
+    different bots and of the server and client side.
+
+    """
+
+    def __init__(self, **labels: str) -> None:
+        self.labels = labels
+        self.in_flight = 0
+        self.response_count = 0
+        self.time_to_first_event = Histogram(LATENCY_BUCKETS)
+        self.event_gap = Histogram(LATENCY_BUCKETS)
+        self.duration = Histogram(LATENCY_BUCKETS)
+        self.events = Histogram(EVENT_COUNT_BUCKETS)
+        self.response_chars = Histogram(CHARACTER_BUCKETS)
+        self.errors: Dict[str, int] = {}
+        _registry.add(self)
+
+    def start(self, started_at: Optional[float] = None) -> StreamRecorder:
+        """Start recording a response that began at *started_at* (default: now)."""
+        if started_at is None:
+            started_at = time.monotonic()
+        return StreamRecorder(self, started_at)
+
+
+_HISTOGRAMS = (
+    (
+        "time_to_first_event_seconds",
+        "time_to_first_event",
+        "Time from the request until the first event of the response.",
+    ),
+    ("event_gap_seconds", "event_gap", "Time between consecutive events."),
+    ("duration_seconds", "duration", "Time from the request until the last event."),
+    ("events", "events", "Number of events per response."),
+    (
+        "response_characters",
+        "response_chars",
+        "Characters of response text per response.",
+    ),
+)
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in sorted(labels.items()):
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def render_metrics(
+    extra: Iterable[Tuple[str, str, str, float]] = (), *, prefix: str = "poe_"
+) -> str:
+    """Render all StreamMetrics, followed by the *extra* metrics.
+
+    Each extra metric is a (name, type, help, value) tuple, where type is "gauge"
+    or "counter".
+
+    """
+    all_metrics = sorted(_registry, key=lambda m: sorted(m.labels.items()))
+    lines: List[str] = []
+
+    def add_family(name: str, kind: str, help: str) -> str:
+        full_name = prefix + name
+        lines.append(f"# HELP {full_name} {help}")
+        lines.append(f"# TYPE {full_name} {kind}")
+        return full_name
+
+    name = add_family("streams_in_flight", "gauge", "Responses being streamed.")
+    for metrics in all_metrics:
+        lines.append(f"{name}{_format_labels(metrics.labels)} {metrics.in_flight}")
+    name = add_family("responses_total", "counter", "Responses finished.")
+    for metrics in all_metrics:
+        labels = _format_labels(metrics.labels)
+        lines.append(f"{name}{labels} {metrics.response_count}")
+    name = add_family("errors_total", "counter", "Errors by type.")
+    for metrics in all_metrics:
+        for error_type, count in sorted(metrics.errors.items()):
+            labels = _format_labels({**metrics.labels, "type": error_type})
+            lines.append(f"{name}{labels} {count}")
+
+    for suffix, attribute, help in _HISTOGRAMS:
+        name = add_family(suffix, "histogram", help)
+        for metrics in all_metrics:
+            histogram: Histogram = getattr(metrics, attribute)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                labels = _format_labels({**metrics.labels, "le": str(bound)})
+                lines.append(f"{name}_bucket{labels} {cumulative}")
+            labels = _format_labels({**metrics.labels, "le": "+Inf"})
+            lines.append(f"{name}_bucket{labels} {histogram.count}")
+            labels = _format_labels(metrics.labels)
+            lines.append(f"{name}_sum{labels} {_format_value(histogram.sum)}")
+            lines.append(f"{name}_count{labels} {histogram.count}")
+
+    for extra_name, kind, help, value in extra:
+        name = add_family(extra_name, kind, help)
+        lines.append(f"{name} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,317 @@
+"""
+
+Caching state that a bot derives from a conversation between queries.
+
+Each query carries the whole conversation, so a bot that builds something from the
+messages (a prompt, token counts, embeddings) would otherwise rebuild it from scratch
+on every turn. A ConversationStateStore remembers the state the bot saved for a
+conversation, together with a hash of the messages it covers, and hands it back for
+the longest prefix of a later query's messages that it matches. The bot then only
+needs to process the messages after that prefix.
+
+"""
+import asyncio
+import hashlib
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator, List, Optional, Sequence, TypeVar
+
+from .types import LazyProtocolMessages, ProtocolMessage
+
+T = TypeVar("T")
+
+
+def _message_key(message: ProtocolMessage) -> bytes:
+    if message.message_id:
+        return b"i" + message.message_id.encode()
+    return f"c{message.role}:".encode() + message.content.encode()
+
+
+def _message_keys(messages: Sequence[ProtocolMessage]) -> Iterator[bytes]:
+    if not isinstance(messages, LazyProtocolMessages):
+        for message in messages:
+            yield _message_key(message)
+        return
+    # Read the raw messages where possible, so that lazy queries stay unvalidated
+    for index, raw in enumerate(messages.raw_messages):
+        message_id = raw.get("message_id")
+        role = raw.get("role")
+        content = raw.get("content")
+        if isinstance(message_id, str) and message_id:
+            yield b"i" + message_id.encode()
+        elif not message_id and isinstance(role, str) and isinstance(content, str):
+            yield f"c{role}:".encode() + content.encode()
+        else:
+            yield _message_key(messages[index])
+
+
+def message_prefix_hashes(messages: Sequence[ProtocolMessage]) -> List[str]:
+    """Return one hash per message, covering that message and all before it.
+
+    Messages are identified by their message_id, or by their role and content if
+    they have none. The messages of a LazyProtocolMessages are not validated.
+
+    """
+    hashes = []
+    digest = b""
+    for key in _message_keys(messages):
+        hasher = hashlib.sha256(digest)
+        hasher.update(key)
+        digest = hasher.digest()
+        hashes.append(digest.hex())
+    return hashes
+
+
+@dataclass
+class CachedState:
+    """State saved for the first *message_count* messages of a conversation."""
+
+    state: Any
+    message_count: int
+
+
+class ConversationStateStore:
+    """Base class for conversation state stores.
+
+    Subclasses implement get_snapshot(), save_snapshot() and delete(). Each
+    conversation keeps up to *max_snapshots* states for different prefixes, so that
+    going back to an earlier point (e.g. regenerating a response) still finds one.
+    Conversations that have not been accessed for *ttl* seconds are dropped. If it
+    is not set, PoeBot sets it to the context_clear_window_secs of its settings,
+    since Poe starts a new context after that long anyway.
+
+    """
+
+    def __init__(self, *, ttl: Optional[float] = None, max_snapshots: int = 4) -> None:
+        self.ttl = ttl
+        self.max_snapshots = max_snapshots
+        self.hit_count = 0
+        self.miss_count = 0
+
+    async def get(
+        self, conversation_id: str, messages: Sequence[ProtocolMessage]
+    ) -> Optional[CachedState]:
+        """Return the state saved for the longest prefix of *messages*, if any."""
+        cached = None
+        if messages:
+            cached = await self.get_snapshot(
+                conversation_id, message_prefix_hashes(messages)
+            )
+        if cached is None:
+            self.miss_count += 1
+        else:
+            self.hit_count += 1
+        return cached
+
+    async def put(
+        self, conversation_id: str, messages: Sequence[ProtocolMessage], state: Any
+    ) -> None:
+        """Save *state* as derived from *messages*."""
+        if messages:
+            prefix_hash = message_prefix_hashes(messages)[-1]
+            await self.save_snapshot(conversation_id, prefix_hash, len(messages), state)
+
+    async def get_snapshot(
+        self, conversation_id: str, prefix_hashes: Sequence[str]
+    ) -> Optional[CachedState]:
+        """Return the saved state whose prefix hash is latest in *prefix_hashes*."""
+        raise NotImplementedError
+
+    async def save_snapshot(
+        self, conversation_id: str, prefix_hash: str, message_count: int, state: Any
+    ) -> None:
+        raise NotImplementedError
+
+    async def delete(self, conversation_id: str) -> None:
+        raise NotImplementedError
+
+
+@dataclass
+class _Conversation:
+    accessed_at: float
+    # Prefix hash -> state, oldest first
+    snapshots: "OrderedDict[str, CachedState]" = field(default_factory=OrderedDict)
+
+
+class InMemoryStateStore(ConversationStateStore):
+    """Keeps states in memory, for the *max_conversations* most recently used
+    conversations.
+
+    States are returned as saved, not copied, so don't modify them in place.
+
+    """
+
+    def __init__(
+        self,
+        *,
+        ttl: Optional[float] = None,
+        max_snapshots: int = 4,
+        max_conversations: int = 1000,
+    ) -> None:
+        super().__init__(ttl=ttl, max_snapshots=max_snapshots)
+        self.max_conversations = max_conversations
+        self._conversations: "OrderedDict[str, _Conversation]" = OrderedDict()
+
+    async def get_snapshot(
+        self, conversation_id: str, prefix_hashes: Sequence[str]
+    ) -> Optional[CachedState]:
+        conversation = self._get_conversation(conversation_id)
+        if conversation is None:
+            return None
+        for prefix_hash in reversed(prefix_hashes):
+            cached = conversation.snapshots.get(prefix_hash)
+            if cached is not None:
+                return cached
+        return None
+
+    async def save_snapshot(
+        self, conversation_id: str, prefix_hash: str, message_count: int, state: Any
+    ) -> None:
+        conversation = self._get_conversation(conversation_id)
+        if conversation is None:
+            conversation = _Conversation(accessed_at=time.monotonic())
+            self._conversations[conversation_id] = conversation
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+        conversation.snapshots.pop(prefix_hash, None)
+        conversation.snapshots[prefix_hash] = CachedState(state, message_count)
+        while len(conversation.snapshots) > self.max_snapshots:
+            conversation.snapshots.popitem(last=False)
+
+    async def delete(self, conversation_id: str) -> None:
+        self._conversations.pop(conversation_id, None)
+
+    def _get_conversation(self, conversation_id: str) -> Optional[_Conversation]:
+        self._evict_expired()
+        conversation = self._conversations.get(conversation_id)
+        if conversation is not None:
+            conversation.accessed_at = time.monotonic()
+            self._conversations.move_to_end(conversation_id)
+        return conversation
+
+    def _evict_expired(self) -> None:
+        if self.ttl is None:
+            return
+        cutoff = time.monotonic() - self.ttl
+        # Least recently used first, so stop at the first one that is still fresh
+        while self._conversations:
+            conversation = next(iter(self._conversations.values()))
+            if conversation.accessed_at >= cutoff:
+                break
+            self._conversations.popitem(last=False)
+
+
+class SQLiteStateStore(ConversationStateStore):
+    """Keeps states in a local SQLite database, so they survive restarts and are
+    shared between worker processes.
+
+    States are stored with pickle, so they must be picklable, and the database must
+    only be writable by the bot.
+
+    """
+
+    def __init__(
+        self, path: str, *, ttl: Optional[float] = None, max_snapshots: int = 4
+    ) -> None:
+        super().__init__(ttl=ttl, max_snapshots=max_snapshots)
+        self.path = path
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    async def get_snapshot(
+        self, conversation_id: str, prefix_hashes: Sequence[str]
+    ) -> Optional[CachedState]:
+        def get() -> Optional[CachedState]:
+            connection = self._get_connection()
+            self._evict_expired(connection)
+            rows = connection.execute(
+                "SELECT prefix_hash, message_count FROM snapshots"
+                " WHERE conversation_id = ?",
+                (conversation_id,),
+            ).fetchall()
+            counts = dict(rows)
+            for prefix_hash in reversed(prefix_hashes):
+                if prefix_hash not in counts:
+                    continue
+                connection.execute(
+                    "UPDATE snapshots SET accessed_at = ? WHERE conversation_id = ?",
+                    (time.time(), conversation_id),
+                )
+                (data,) = connection.execute(
+                    "SELECT state FROM snapshots"
+                    " WHERE conversation_id = ? AND prefix_hash = ?",
+                    (conversation_id, prefix_hash),
+                ).fetchone()
+                return CachedState(pickle.loads(data), counts[prefix_hash])
+            return None
+
+        return await self._run(get)
+
+    async def save_snapshot(
+        self, conversation_id: str, prefix_hash: str, message_count: int, state: Any
+    ) -> None:
+        data = pickle.dumps(state)
+
+        def save() -> None:
+            connection = self._get_connection()
+            now = time.time()
+            connection.execute(
+                "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?)",
+                (conversation_id, prefix_hash, message_count, data, now, now),
+            )
+            connection.execute(
+                "UPDATE snapshots SET accessed_at = ? WHERE conversation_id = ?",
+                (now, conversation_id),
+            )
+            connection.execute(
+                "DELETE FROM snapshots WHERE conversation_id = ? AND prefix_hash NOT IN"
+                " (SELECT prefix_hash FROM snapshots WHERE conversation_id = ?"
+                " ORDER BY saved_at DESC LIMIT ?)",
+                (conversation_id, conversation_id, self.max_snapshots),
+            )
+
+        await self._run(save)
+
+    async def delete(self, conversation_id: str) -> None:
+        def delete() -> None:
+            self._get_connection().execute(
+                "DELETE FROM snapshots WHERE conversation_id = ?", (conversation_id,)
+            )
+
+        await self._run(delete)
+
+    async def _run(self, function: Callable[[], T]) -> T:
+        def run() -> T:
+            with self._lock:
+                connection = self._get_connection()
+                with connection:
+                    return function()
+
+        return await asyncio.get_event_loop().run_in_executor(None, run)
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS snapshots (conversation_id TEXT,"
+                " prefix_hash TEXT, message_count INTEGER, state BLOB,"
+                " saved_at REAL, accessed_at REAL,"
+                " PRIMARY KEY (conversation_id, prefix_hash))"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS snapshots_accessed_at"
+                " ON snapshots (accessed_at)"
+            )
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def _evict_expired(self, connection: sqlite3.Connection) -> None:
+        if self.ttl is not None:
+            connection.execute(
+                "DELETE FROM snapshots WHERE accessed_at < ?", (time.time() - self.ttl,)
+            )
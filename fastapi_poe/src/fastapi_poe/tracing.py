@@ -0,0 +1,148 @@
+"""
+
+Tracing and profiling individual queries.
+
+A QueryTrace collects the timings of one query and is passed to the tracing hooks of
+PoeBot. The SamplingProfiler periodically samples the stack of the event loop
+thread while a query is being answered and writes the stacks it saw in the
+collapsed format used by flamegraph tools (one "outer;inner;leaf count" per line).
+
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from types import CodeType, FrameType
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+logger = logging.getLogger("uvicorn.default")
+
+
+@dataclass
+class QueryTrace:
+    """Timings of a single query. Times are time.monotonic() values."""
+
+    received_at: float
+    parsed_at: Optional[float] = None
+    first_event_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    event_count: int = 0
+    # Seconds spent producing events, i.e. in get_response() and the wrappers
+    # around it, and seconds spent sending them (serialization and socket writes)
+    response_time: float = 0.0
+    send_time: float = 0.0
+    error: Optional[BaseException] = None
+    # Where the collapsed stacks are written, if this query is profiled
+    profile_path: Optional[str] = None
+
+
+class _Profile:
+    def __init__(self, frame: FrameType, thread_id: int, path: str) -> None:
+        # Frames whose callees are sampled; the query may run in several tasks
+        self.frames: Set[FrameType] = {frame}
+        self.thread_id = thread_id
+        self.path = path
+        self.counts: Dict[str, int] = {}
+
+
+class SamplingProfiler:
+    """Samples the stacks of running queries from a background thread.
+
+    Only frames below the frame passed to start(), or to add_frame() for other tasks
+    working on the query, are recorded, so the samples of concurrent queries do not
+    mix. Time spent waiting, e.g. for a model API, is not
+    sampled; the profile shows where the event loop thread spends CPU time on the
+    query.
+
+    """
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._profiles: List[_Profile] = []
+        self._finished: List[_Profile] = []
+        self._thread: Optional[threading.Thread] = None
+        self._names: Dict[CodeType, str] = {}
+
+    def start(self, frame: FrameType, path: str) -> _Profile:
+        """Start sampling the stacks below *frame*, to be written to *path*."""
+        profile = _Profile(frame, threading.get_ident(), path)
+        with self._lock:
+            self._profiles.append(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="poe-profiler", daemon=True
+                )
+                self._thread.start()
+        return profile
+
+    def add_frame(self, profile: _Profile, frame: FrameType) -> None:
+        """Also sample the stacks below *frame*, e.g. in another task of the query."""
+        with self._lock:
+            profile.frames.add(frame)
+
+    def stop(self, profile: _Profile) -> None:
+        """Stop sampling; the profile is written from the background thread."""
+        with self._lock:
+            self._profiles.remove(profile)
+            self._finished.append(profile)
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                profiles = [
+                    (profile, frozenset(profile.frames)) for profile in self._profiles
+                ]
+                finished = self._finished
+                self._finished = []
+                if not profiles and not finished:
+                    self._thread = None
+                    return
+            for profile in finished:
+                self._write(profile)
+            if profiles:
+                frames = sys._current_frames()
+                for profile, roots in profiles:
+                    frame = frames.get(profile.thread_id)
+                    if frame is not None:
+                        self._sample(profile, roots, frame)
+            time.sleep(self.interval)
+
+    def _sample(
+        self, profile: _Profile, roots: FrozenSet[FrameType], frame: FrameType
+    ) -> None:
+        stack: List[str] = []
+        current: Optional[FrameType] = frame
+        while current is not None:
+            stack.append(self._get_name(current.f_code))
+            if current in roots:
+                break
+            current = current.f_back
+        else:
+            # The query is not running right now
+            return
+        key = ";".join(reversed(stack))
+        profile.counts[key] = profile.counts.get(key, 0) + 1
+
+    def _get_name(self, code: CodeType) -> str:
+        name = self._names.get(code)
+        if name is None:
+            filename = os.path.basename(code.co_filename)
+            # Semicolons separate the frames of a collapsed stack
+            name = f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(
+                ";", ":"
+            )
+            self._names[code] = name
+        return name
+
+    def _write(self, profile: _Profile) -> None:
+        lines: List[Tuple[str, int]] = sorted(profile.counts.items())
+        try:
+            os.makedirs(os.path.dirname(profile.path) or ".", exist_ok=True)
+            with open(profile.path, "w") as f:
+                for stack, count in lines:
+                    f.write(f"{stack} {count}\n")
+        except OSError:
+            logger.exception(f"Could not write profile to {profile.path}")
@@ -1,4 +1,4 @@
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Union, cast, overload
 
 from pydantic import BaseModel, Field
 from typing_extensions import Literal, TypeAlias
@@ -26,6 +26,84 @@ class ProtocolMessage(BaseModel):
     feedback: List[MessageFeedback] = Field(default_factory=list)
 
 
+class LazyProtocolMessages(Sequence[ProtocolMessage]):
+    """The messages of a query, validated only when they are accessed.
+
+    Behaves like a read-only list of ProtocolMessage. Each message is validated the
+    first time it is accessed, so a bot that only looks at the last few messages does
+    not pay for the rest of the conversation. Invalid messages raise a pydantic
+    ValidationError on access.
+
+    """
+
+    def __init__(self, raw_messages: List[Dict[str, Any]]) -> None:
+        self._raw_messages = raw_messages
+        self._validated: Dict[int, ProtocolMessage] = {}
+
+    @property
+    def raw_messages(self) -> List[Dict[str, Any]]:
+        """The messages as received, without validating them."""
+        return self._raw_messages
+
+    def __len__(self) -> int:
+        return len(self._raw_messages)
+
+    @overload
+    def __getitem__(self, index: int) -> ProtocolMessage:
+        ...
+
+    @overload
+    def __getitem__(self, index: slice) -> "LazyProtocolMessages":
+        ...
+
+    def __getitem__(
+        self, index: Union[int, slice]
+    ) -> Union[ProtocolMessage, "LazyProtocolMessages"]:
+        if isinstance(index, slice):
+            return LazyProtocolMessages(self._raw_messages[index])
+        if index < 0:
+            index += len(self._raw_messages)
+        message = self._validated.get(index)
+        if message is None:
+            if not 0 <= index < len(self._raw_messages):
+                raise IndexError("message index out of range")
+            message = ProtocolMessage.parse_obj(self._raw_messages[index])
+            self._validated[index] = message
+        return message
+
+    def __iter__(self) -> Iterator[ProtocolMessage]:
+        for index in range(len(self._raw_messages)):
+            yield self[index]
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+    def window(
+        self, *, max_messages: Optional[int] = None, max_chars: Optional[int] = None
+    ) -> "LazyProtocolMessages":
+        """Return the most recent messages, up to the given limits.
+
+        The last message is always included, even if *max_messages* is less than 1
+        or the message alone exceeds *max_chars*.
+
+        """
+        raw_messages = self._raw_messages
+        if max_messages is not None:
+            start = -max(max_messages, 1)
+            raw_messages = raw_messages[start:]
+        if max_chars is not None:
+            start = len(raw_messages)
+            total_chars = 0
+            while start > 0:
+                content = raw_messages[start - 1].get("content")
+                total_chars += len(content) if isinstance(content, str) else 0
+                if total_chars > max_chars and start < len(raw_messages):
+                    break
+                start -= 1
+            raw_messages = raw_messages[start:]
+        return LazyProtocolMessages(raw_messages)
+
+
 class BaseRequest(BaseModel):
     """Common data for all requests."""
 
@@ -42,6 +120,37 @@ class QueryRequest(BaseRequest):
     message_id: Identifier
     api_key: str = "<missing>"
 
+    @classmethod
+    def parse_lazy(
+        cls,
+        obj: Dict[str, Any],
+        *,
+        max_messages: Optional[int] = None,
+        max_chars: Optional[int] = None,
+    ) -> "QueryRequest":
+        """Parse a query request without validating its messages up front.
+
+        The query is a LazyProtocolMessages holding only the most recent messages
+        within *max_messages* and *max_chars* (see LazyProtocolMessages.window()), so
+        older messages are neither validated nor kept in memory.
+
+        """
+        raw_messages = obj.get("query")
+        if not isinstance(raw_messages, list) or not all(
+            isinstance(message, dict) for message in raw_messages
+        ):
+            # Let pydantic produce the usual validation error
+            return cls.parse_obj(obj)
+        request = cls.parse_obj({**obj, "query": []})
+        # LazyProtocolMessages stands in for the list; bots only read from it.
+        request.query = cast(
+            List[ProtocolMessage],
+            LazyProtocolMessages(raw_messages).window(
+                max_messages=max_messages, max_chars=max_chars
+            ),
+        )
+        return request
+
 
 class SettingsRequest(BaseRequest):
     """Request parameters for a settings request."""
@@ -0,0 +1,273 @@
+"""
+
+Serving a bot app from several worker processes.
+
+uvicorn can only run multiple workers for an app given as an import string, but bots
+are usually constructed in a script and passed to run() as objects. This module forks
+worker processes that each serve the same app object, and supervises them.
+
+"""
+import contextlib
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from dataclasses import dataclass
+from types import FrameType
+from typing import Any, Dict, List, Optional
+
+import uvicorn
+from uvicorn.config import STARTUP_FAILURE
+
+logger = logging.getLogger("uvicorn.default")
+
+# How long to wait for a worker to finish its in-flight responses before killing it.
+# Responses may take up to 120 seconds per the protocol.
+GRACEFUL_SHUTDOWN_TIMEOUT = 125.0
+
+# A worker that exits sooner than this after starting has failed. It is restarted
+# after a delay that doubles with each consecutive failure, up to the maximum, and
+# the server gives up after MAX_WORKER_FAILURES consecutive failures of one worker.
+WORKER_MIN_UPTIME = 10.0
+RESTART_DELAY = 0.5
+MAX_RESTART_DELAY = 30.0
+MAX_WORKER_FAILURES = 5
+
+
+def _make_reuse_port_socket(host: str, port: int, backlog: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+@dataclass
+class _Worker:
+    slot: int
+    started_at: float
+    # When a worker that was asked to stop gets killed if it is still running
+    stop_deadline: Optional[float] = None
+
+
+class _Supervisor:
+    """Keeps *workers* forked worker processes running until asked to stop.
+
+    SIGINT and SIGTERM shut the workers down gracefully. SIGHUP replaces them one
+    at a time, so the server keeps accepting connections during the restart. A
+    worker that keeps failing right after it starts is restarted with exponential
+    backoff, and the server exits with an error once it has failed
+    MAX_WORKER_FAILURES times in a row.
+
+    """
+
+    def __init__(
+        self, config: uvicorn.Config, workers: int, *, reuse_port: bool
+    ) -> None:
+        self.config = config
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.sock: Optional[socket.socket] = None
+        self.pids: Dict[int, _Worker] = {}
+        # Consecutive failures of the worker in each slot, and when to restart it
+        self.failures: Dict[int, int] = {}
+        self.restart_at: Dict[int, float] = {}
+        # Workers still to be replaced by a rolling restart, and the one being replaced
+        self.restart_queue: List[int] = []
+        self.retiring: Optional[int] = None
+        self.should_exit = False
+        self.should_restart = False
+        self.exit_code = 0
+
+    def run(self) -> None:
+        if not self.reuse_port:
+            # All workers accept connections from the same listening socket.
+            self.sock = self.config.bind_socket()
+        signal.signal(signal.SIGINT, self._handle_exit)
+        signal.signal(signal.SIGTERM, self._handle_exit)
+        signal.signal(signal.SIGHUP, self._handle_restart)
+        for slot in range(self.workers):
+            self._spawn(slot)
+        try:
+            while not self.should_exit:
+                if self.should_restart:
+                    self.should_restart = False
+                    logger.info("Restarting worker processes")
+                    self.restart_queue = [
+                        pid
+                        for pid, worker in self.pids.items()
+                        if worker.stop_deadline is None
+                    ]
+                self._reap(respawn=True)
+                self._respawn_due()
+                self._restart_next()
+                time.sleep(0.5)
+        finally:
+            self._stop(list(self.pids))
+            if self.sock is not None:
+                self.sock.close()
+        if self.exit_code:
+            sys.exit(self.exit_code)
+
+    def _handle_exit(self, signum: int, frame: Optional[FrameType]) -> None:
+        self.should_exit = True
+
+    def _handle_restart(self, signum: int, frame: Optional[FrameType]) -> None:
+        self.should_restart = True
+
+    def _spawn(self, slot: int) -> int:
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = _Worker(slot=slot, started_at=time.monotonic())
+            logger.info(f"Started worker process {pid}")
+            return pid
+        # In the worker process
+        exit_code = 0
+        try:
+            for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+                signal.signal(signum, signal.SIG_DFL)
+            sock = self.sock
+            if sock is None:
+                sock = _make_reuse_port_socket(
+                    self.config.host, self.config.port, self.config.backlog
+                )
+            _run_server(self.config, sock)
+        except SystemExit as e:
+            # uvicorn exits this way, e.g. if the app fails to start
+            exit_code = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception:
+            logger.exception("Worker process failed")
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def _reap(self, *, respawn: bool) -> None:
+        for pid, worker in list(self.pids.items()):
+            finished, status = os.waitpid(pid, os.WNOHANG)
+            if not finished:
+                continue
+            del self.pids[pid]
+            if not respawn or self.should_exit or worker.stop_deadline is not None:
+                continue
+            now = time.monotonic()
+            if now - worker.started_at >= WORKER_MIN_UPTIME:
+                self.failures.pop(worker.slot, None)
+                logger.warning(f"Worker process {pid} exited ({status}), restarting it")
+                self._spawn(worker.slot)
+                continue
+            failures = self.failures.get(worker.slot, 0) + 1
+            self.failures[worker.slot] = failures
+            if failures >= MAX_WORKER_FAILURES:
+                logger.error(
+                    f"Worker process {pid} exited ({status}) right after starting"
+                    f" {failures} times in a row, giving up"
+                )
+                self.exit_code = 1
+                self.should_exit = True
+                return
+            delay = min(RESTART_DELAY * 2 ** (failures - 1), MAX_RESTART_DELAY)
+            logger.warning(
+                f"Worker process {pid} exited ({status}) right after starting,"
+                f" restarting it in {delay:.1f}s"
+            )
+            self.restart_at[worker.slot] = now + delay
+
+    def _respawn_due(self) -> None:
+        now = time.monotonic()
+        for slot, restart_at in list(self.restart_at.items()):
+            if restart_at <= now:
+                del self.restart_at[slot]
+                self._spawn(slot)
+
+    def _restart_next(self) -> None:
+        """Replace the next worker of a rolling restart once the last one exited."""
+        if self.retiring is not None:
+            worker = self.pids.get(self.retiring)
+            if worker is not None:
+                assert worker.stop_deadline is not None
+                if time.monotonic() >= worker.stop_deadline:
+                    logger.warning(
+                        f"Worker process {self.retiring} did not exit in time, killing it"
+                    )
+                    with contextlib.suppress(ProcessLookupError):
+                        os.kill(self.retiring, signal.SIGKILL)
+                return
+            self.retiring = None
+        while self.restart_queue:
+            pid = self.restart_queue.pop(0)
+            worker = self.pids.get(pid)
+            if worker is None:
+                # It exited in the meantime and was already replaced
+                continue
+            self._spawn(worker.slot)
+            worker.stop_deadline = time.monotonic() + GRACEFUL_SHUTDOWN_TIMEOUT
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+            self.retiring = pid
+            return
+
+    def _stop(self, pids: List[int]) -> None:
+        for pid in pids:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + GRACEFUL_SHUTDOWN_TIMEOUT
+        for pid in pids:
+            while time.monotonic() < deadline:
+                try:
+                    finished, _ = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if finished:
+                    break
+                time.sleep(0.1)
+            else:
+                logger.warning(f"Worker process {pid} did not exit in time, killing it")
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            self.pids.pop(pid, None)
+
+
+def _run_server(config: uvicorn.Config, sock: Optional[socket.socket] = None) -> None:
+    """Run a uvicorn server, exiting with STARTUP_FAILURE if it fails to start."""
+    server = uvicorn.Server(config)
+    server.run(sockets=None if sock is None else [sock])
+    if not server.started:
+        # uvicorn.run() exits this way, but Server.run() returns normally
+        sys.exit(STARTUP_FAILURE)
+
+
+def serve(
+    app: Any,
+    *,
+    host: str,
+    port: int,
+    workers: int = 1,
+    reuse_port: bool = False,
+    **config_kwargs: Any,
+) -> None:
+    """Serve *app* with uvicorn from one or more worker processes.
+
+    :param workers: Number of worker processes. With more than one, the processes
+    are forked from this one, so they share the already-constructed app.
+    :param reuse_port: Give each worker its own listening socket bound with
+    SO_REUSEPORT, letting the kernel balance connections between them, instead of
+    sharing a single socket.
+    :param config_kwargs: Passed on to uvicorn.Config, e.g. loop, http,
+    timeout_keep_alive, backlog or log_config.
+
+    """
+    config = uvicorn.Config(app, host=host, port=port, **config_kwargs)
+    if workers > 1 and not hasattr(os, "fork"):
+        logger.warning("Multiple workers need os.fork(); starting a single worker")
+        workers = 1
+    if workers == 1:
+        sock = None
+        if reuse_port:
+            sock = _make_reuse_port_socket(host, port, config.backlog)
+        _run_server(config, sock)
+        return
+    _Supervisor(config, workers, reuse_port=reuse_port).run()
@@ -0,0 +1,111 @@
+import asyncio
+import json
+from typing import Any, List, Optional, Tuple
+
+import httpx
+import pytest
+
+from fastapi_poe.base import PoeBot, _ReplayBuffer, make_app
+from fastapi_poe.types import ProtocolMessage, QueryRequest
+
+API_KEY = "k" * 32
+
+
+def test_replay_buffer_reader_behind_window() -> None:
+    async def events():
+        for i in range(5):
+            yield PoeBot.text_event(str(i))
+        yield PoeBot.done_event()
+
+    async def run() -> List[Tuple[Optional[str], Any]]:
+        buffer = _ReplayBuffer(max_events=3, abandon_timeout=10)
+        buffer.start(events())
+        assert buffer.task is not None
+        await buffer.task
+        return [(event.event, event.data) async for event in buffer.follow(0)]
+
+    (error, error_data), (done, _) = asyncio.run(run())
+    assert error == "error"
+    assert json.loads(error_data)["allow_retry"] is False
+    assert done == "done"
+
+
+def test_evicted_response_is_not_counted_as_aborted() -> None:
+    class Bot(PoeBot):
+        replay_buffer_max_messages = 1
+
+        async def get_response(self, query: QueryRequest):
+            yield self.text_event("a")
+            await asyncio.sleep(10)
+
+    def make_query(message_id: str) -> QueryRequest:
+        return QueryRequest(
+            version="1.0",
+            type="query",
+            query=[ProtocolMessage(role="user", content="hello")],
+            user_id="u",
+            conversation_id="c",
+            message_id=message_id,
+        )
+
+    async def run() -> None:
+        bot = Bot()
+        first = bot.handle_resumable_query(make_query("m1"))
+        await first.__anext__()
+        second = bot.handle_resumable_query(make_query("m2"))
+        await second.__anext__()
+        await asyncio.sleep(0.01)
+        assert (bot.evicted_stream_count, bot.aborted_stream_count) == (1, 0)
+        await second.aclose()
+        await first.aclose()
+        assert bot._replay_buffers is not None
+        bot._replay_buffers["m2"].cancel()
+        await asyncio.sleep(0.01)
+        assert (bot.evicted_stream_count, bot.aborted_stream_count) == (1, 1)
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize(
+    "authorization",
+    [None, "", "Bearer", f"Basic {API_KEY}", f"bearer {API_KEY}", "Bearer wrong"],
+)
+def test_fast_path_rejects_like_default_route(authorization: Optional[str]) -> None:
+    headers = {} if authorization is None else {"Authorization": authorization}
+
+    async def post(fast_path: bool) -> Tuple[int, Any, Optional[str]]:
+        app = make_app(PoeBot(), api_key=API_KEY, fast_path=fast_path)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bot"
+        ) as client:
+            response = await client.post(
+                "/", json={"type": "settings", "version": "1.0"}, headers=headers
+            )
+        return (
+            response.status_code,
+            response.json(),
+            response.headers.get("WWW-Authenticate"),
+        )
+
+    default = asyncio.run(post(fast_path=False))
+    assert default[0] in (401, 403)
+    assert asyncio.run(post(fast_path=True)) == default
+
+
+def test_fast_path_accepts_api_key() -> None:
+    async def post(fast_path: bool) -> int:
+        app = make_app(PoeBot(), api_key=API_KEY, fast_path=fast_path)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bot"
+        ) as client:
+            response = await client.post(
+                "/",
+                json={"type": "settings", "version": "1.0"},
+                headers={"Authorization": f"Bearer {API_KEY}"},
+            )
+        return response.status_code
+
+    assert asyncio.run(post(fast_path=False)) == 200
+    assert asyncio.run(post(fast_path=True)) == 200
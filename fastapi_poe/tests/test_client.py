@@ -0,0 +1,112 @@
+import asyncio
+import json
+from typing import List, Optional
+
+import httpx
+import pytest
+
+from fastapi_poe.client import BotErrorNoRetry, PoeClient, _BotContext, _StreamState
+from fastapi_poe.types import ProtocolMessage, QueryRequest
+
+REQUEST = QueryRequest(
+    version="1.0",
+    type="query",
+    query=[ProtocolMessage(role="user", content="hello")],
+    user_id="u",
+    conversation_id="c",
+    message_id="m",
+)
+
+
+def text_event(event_id: str, text: str) -> str:
+    return f"id: {event_id}\nevent: text\ndata: {json.dumps({'text': text})}\n\n"
+
+
+PING = "event: ping\ndata: {}\n\n"
+
+
+def stream(body: str, resume_from: Optional[str] = None) -> List[str]:
+    """Returns the text of a response served as *body*."""
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        assert request.headers.get("Last-Event-ID") == resume_from
+        return httpx.Response(
+            200, text=body, headers={"content-type": "text/event-stream"}
+        )
+
+    async def run() -> List[str]:
+        transport = httpx.MockTransport(handler)
+        async with httpx.AsyncClient(transport=transport) as session:
+            context = _BotContext(
+                endpoint="http://bot/", api_key="key", session=session
+            )
+            state = _StreamState(last_event_id=resume_from)
+            return [
+                message.text
+                async for message in context.perform_query_request(REQUEST, state)
+            ]
+
+    return asyncio.run(run())
+
+
+def test_ping_between_numbered_events() -> None:
+    body = (
+        text_event("1", "a") + PING + text_event("2", "b") + "event: done\ndata: {}\n\n"
+    )
+    assert stream(body) == ["a", "b"]
+
+
+def test_resume_with_ping() -> None:
+    body = (
+        PING
+        + text_event("3", "c")
+        + PING
+        + text_event("4", "d")
+        + "event: done\ndata: {}\n\n"
+    )
+    assert stream(body, resume_from="2") == ["c", "d"]
+
+
+def test_resume_with_ping_after_repeated_id() -> None:
+    # The ping after event 3 carries its ID again
+    body = text_event("3", "c") + PING + "event: done\ndata: {}\n\n"
+    assert stream(body, resume_from="2") == ["c"]
+
+
+def test_restarted_stream() -> None:
+    body = (
+        PING + text_event("1", "a") + text_event("2", "b") + "event: done\ndata: {}\n\n"
+    )
+    with pytest.raises(BotErrorNoRetry):
+        stream(body, resume_from="2")
+
+
+def test_ordered_batch_bounds_queries_ahead_of_results() -> None:
+    max_concurrency = 4
+
+    class Client(PoeClient):
+        async def get_final_response(self, request: QueryRequest, bot_name: str) -> str:
+            index = int(request.message_id)
+            started.append(index)
+            if index == 0:
+                # Later queries finish first and wait for this one to be yielded
+                await asyncio.sleep(0.05)
+            return str(index)
+
+    started: List[int] = []
+    queries = [
+        ("bot", REQUEST.copy(update={"message_id": str(index)})) for index in range(20)
+    ]
+
+    async def run() -> List[int]:
+        batch = Client("key").batch(
+            queries, max_concurrency=max_concurrency, ordered=True
+        )
+        results = []
+        async for result in batch:
+            if result.index == 0:
+                assert max(started) < max_concurrency
+            results.append(result.index)
+        return results
+
+    assert asyncio.run(run()) == list(range(20))
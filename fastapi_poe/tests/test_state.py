@@ -0,0 +1,14 @@
+from fastapi_poe.state import message_prefix_hashes
+from fastapi_poe.types import LazyProtocolMessages
+
+RAW_MESSAGES = [
+    {"role": "user", "content": "hello"},
+    {"role": "bot", "content": "hi", "message_id": "m"},
+]
+
+
+def test_prefix_hashes_of_lazy_messages() -> None:
+    messages = LazyProtocolMessages(RAW_MESSAGES)
+    hashes = message_prefix_hashes(messages)
+    assert not messages._validated
+    assert hashes == message_prefix_hashes(list(messages))
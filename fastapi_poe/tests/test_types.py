@@ -0,0 +1,16 @@
+import pytest
+
+from fastapi_poe.types import LazyProtocolMessages
+
+RAW_MESSAGES = [{"role": "user", "content": str(i)} for i in range(3)]
+
+
+@pytest.mark.parametrize("max_messages", [-1, 0, 1])
+def test_window_keeps_last_message(max_messages: int) -> None:
+    window = LazyProtocolMessages(RAW_MESSAGES).window(max_messages=max_messages)
+    assert [message.content for message in window] == ["2"]
+
+
+def test_window_max_chars() -> None:
+    window = LazyProtocolMessages(RAW_MESSAGES).window(max_chars=2)
+    assert [message.content for message in window] == ["1", "2"]
@@ -9,6 +9,7 @@ from langchain.schema import AIMessage, HumanMessage, SystemMessage
 from sse_starlette.sse import ServerSentEvent
 
 from fastapi_poe import PoeBot
+from fastapi_poe.state import InMemoryStateStore
 from fastapi_poe.types import QueryRequest
 
 template = """You are an automated cat.
@@ -20,14 +21,18 @@ and you are easily distracted."""
 @dataclass
 class LangChainCatBot(PoeBot):
     openai_key: str
+    conversation_state_store = InMemoryStateStore()
 
     async def get_response(self, query: QueryRequest) -> AsyncIterable[ServerSentEvent]:
-        messages = [SystemMessage(content=template)]
-        for message in query.query:
+        # Only convert the messages added since the last query in this conversation
+        cached_messages, new_messages = await self.get_conversation_state(query)
+        messages = list(cached_messages or [SystemMessage(content=template)])
+        for message in new_messages:
             if message.role == "bot":
                 messages.append(AIMessage(content=message.content))
             elif message.role == "user":
                 messages.append(HumanMessage(content=message.content))
+        await self.save_conversation_state(query, messages)
         handler = AsyncIteratorCallbackHandler()
         chat = ChatOpenAI(
             openai_api_key=self.openai_key,
@@ -35,6 +40,6 @@ class LangChainCatBot(PoeBot):
             callback_manager=AsyncCallbackManager([handler]),
             temperature=0,
         )
-        asyncio.create_task(chat.agenerate([messages]))
+        self.register_task(asyncio.create_task(chat.agenerate([messages])))
         async for token in handler.aiter():
             yield self.text_event(token)
@@ -18,6 +18,7 @@ from poe_api.types import AddDocumentsRequest, Document
 from sse_starlette.sse import ServerSentEvent
 
 from fastapi_poe.base import PoeBot
+from fastapi_poe.state import InMemoryStateStore
 from fastapi_poe.types import (
     QueryRequest,
     ReportFeedbackRequest,
@@ -108,16 +109,16 @@ def _get_chat_history(chat_history: list[tuple[str, str]]) -> str:
 class LlamaBot(PoeBot):
     def __init__(self) -> None:
         """Setup LlamaIndex."""
-        self._chat_history = {}
+        self.conversation_state_store = InMemoryStateStore(
+            ttl=SETTINGS.context_clear_window_secs
+        )
         self._index = _create_or_load_index()
 
     async def get_response(self, query: QueryRequest) -> AsyncIterable[ServerSentEvent]:
         """Return an async iterator of events to send to the user."""
         # Get chat history
-        chat_history = self._chat_history.get(query.conversation_id)
-        if chat_history is None:
-            chat_history = []
-            self._chat_history[query.conversation_id] = chat_history
+        cached_history, _ = await self.get_conversation_state(query)
+        chat_history = list(cached_history or [])
 
         # Get last message
         last_message = query.query[-1].content
@@ -130,8 +131,9 @@ class LlamaBot(PoeBot):
 
         chat_history_str = _get_chat_history(chat_history)
         logger.debug(chat_history_str)
-        new_question = question_generator.run(
-            question=last_message, chat_history=chat_history_str
+        # This blocks, so run it on the bot's thread pool
+        new_question = await self.run_sync(
+            question_generator.run, question=last_message, chat_history=chat_history_str
         )
         logger.info(f"Querying with: {new_question}")
 
@@ -140,11 +142,13 @@ class LlamaBot(PoeBot):
             new_question, streaming=True, similarity_top_k=3
         )
         full_response = ""
-        for text in response.response_gen:
+        # The response generator blocks while it waits for tokens
+        async for text in self.iterate_sync(response.response_gen):
             full_response += text
             yield self.text_event(text)
 
         chat_history.append((last_message, full_response))
+        await self.save_conversation_state(query, chat_history)
 
     async def on_feedback(self, feedback: ReportFeedbackRequest) -> None:
         """Called when we receive user feedback such as likes."""
@@ -10,9 +10,9 @@ from fastapi.responses import HTMLResponse
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from poe_api import llama_handler
 from poe_api.types import AddDocumentsRequest
-from poe_api.utils import LoggingMiddleware
 from sse_starlette.sse import EventSourceResponse
 
+from fastapi_poe.base import LoggingMiddleware
 from fastapi_poe.types import (
     QueryRequest,
     ReportErrorRequest,
@@ -47,7 +47,7 @@ def auth_user(
 app = FastAPI()
 app.add_exception_handler(RequestValidationError, exception_handler)
 
-# Uncomment this line to print out request and response
+# Logs one line per request, and truncated bodies at debug level
 app.add_middleware(LoggingMiddleware)
 logger.info("Starting")
 